@@ -0,0 +1,85 @@
+#! /usr/env python3
+
+import json
+import numpy as np
+import os
+import pandas as pd
+
+
+# binary matrix directories hold a json header and raw C ordered arrays, values.bin with a (rows, columns) value block
+# and for methylation sites chromosome_codes.bin and positions.bin, so each array can be memory mapped with np.memmap
+BINARY_MATRIX_VERSION = 1
+
+
+def write_binary_matrix(path=None, blocks=None, column_labels=None, sites=False, dtype=np.float32):
+    """Write a matrix to a binary matrix directory block by block, so matrices larger than memory can be converted
+    ----------------------------------------
+    input; path, directory to write, created if missing and overwritten if present
+    input; blocks, iterable of (row_labels, values) blocks, or (chromosome, positions, values) blocks if sites is set,
+        the block format yielded by kNNimputer.read_matrix_blocks
+    input; column_labels, sample or trait labels
+    input; sites=False, rows are methylation sites stored as int32 chromosome codes and int64 positions rather than
+        row labels
+    input; dtype=np.float32, value type of the value block"""
+    os.makedirs(path, exist_ok=True)
+    column_labels = pd.Index(column_labels).tolist()
+    # the header is written last, remove any previous header so a partially written matrix is never loaded
+    header_path = os.path.join(path, 'header.json')
+    if os.path.exists(header_path):
+        os.remove(header_path)
+    array_names = ('values', 'chromosome_codes', 'positions') if sites else ('values',)
+    array_files = {name: open(os.path.join(path, name + '.bin'), 'wb') for name in array_names}
+    row_count, row_labels, chromosomes = 0, [], {}
+    try:
+        for block in blocks:
+            values = np.ascontiguousarray(block[-1], dtype=dtype).reshape(-1, len(column_labels))
+            values.tofile(array_files['values'])
+            if sites:
+                chromosome_code = chromosomes.setdefault(block[0], len(chromosomes))
+                np.full(len(values), chromosome_code, dtype=np.int32).tofile(array_files['chromosome_codes'])
+                np.ascontiguousarray(block[1], dtype=np.int64).tofile(array_files['positions'])
+            else:
+                row_labels.extend(pd.Index(block[0]).tolist())
+            row_count += len(values)
+    finally:
+        for array_file in array_files.values():
+            array_file.close()
+    header = {'version': BINARY_MATRIX_VERSION, 'shape': [row_count, len(column_labels)],
+              'dtype': np.dtype(dtype).str, 'column_labels': column_labels,
+              'row_labels': None if sites else row_labels,
+              'chromosomes': [str(chromosome) for chromosome in chromosomes] if sites else None}
+    with open(header_path + '.tmp', 'w') as header_file:
+        json.dump(header, header_file, default=str)
+    os.replace(header_path + '.tmp', header_path)
+
+
+def load_binary_matrix(path=None, mmap_mode='r'):
+    """Load a binary matrix directory, arrays are memory mapped so no values are read until they are used
+    ----------------------------------------
+    input; path, directory written by write_binary_matrix
+    input; mmap_mode='r', np.memmap mode, 'r' for read only values, 'c' for copy on write values that can be edited
+        in memory without changing the file
+    returns; values, (rows, columns) memory mapped value block
+    returns; column_labels, list of sample or trait labels
+    returns; row_labels, list of row labels, None for methylation sites
+    returns; site_index, (chromosome_codes, chromosomes, positions) as returned by kNNimputer.parse_site_labels, None
+        if rows are not methylation sites"""
+    with open(os.path.join(path, 'header.json')) as header_file:
+        header = json.load(header_file)
+    if header['version'] != BINARY_MATRIX_VERSION:
+        raise ValueError('Unsupported binary matrix version ' + str(header['version']))
+    row_count, column_count = header['shape']
+
+    def load_array(name, dtype, shape):
+        # zero length files cannot be memory mapped
+        if not row_count:
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(os.path.join(path, name + '.bin'), dtype=dtype, mode=mmap_mode, shape=shape)
+
+    values = load_array('values', np.dtype(header['dtype']), (row_count, column_count))
+    site_index = None
+    if header['chromosomes'] is not None:
+        site_index = (load_array('chromosome_codes', np.int32, (row_count,)),
+                      np.asarray(header['chromosomes'], dtype=object),
+                      load_array('positions', np.int64, (row_count,)))
+    return values, header['column_labels'], header['row_labels'], site_index
@@ -0,0 +1,160 @@
+#! /usr/env python3
+
+import argparse
+from collections import deque
+import gzip
+from itertools import groupby
+from multiprocessing import cpu_count
+from multiprocessing import Pool
+import numpy as np
+import os
+from binary_matrix import load_binary_matrix
+from kNNimputer import kNNimputer
+
+
+def nan_correlation(array=None):
+    """Pairwise Pearson correlation between rows, NaN values are dropped pairwise so each correlation is calculated
+    only over the columns observed in both rows. Correlations with fewer than two shared columns or without variance
+    over the shared columns are undefined and set to 0
+    ----------------------------------------
+    input: numpy array with sites as rows and samples as columns
+    output: pairwise correlation array"""
+    array = np.asarray(array, dtype=np.float64)
+    observed = ~np.isnan(array)
+    observed_float = observed.astype(np.float64)
+    values = np.where(observed, array, 0.0)
+    # sums over the columns observed in both rows, sums[i, j] is the sum of row i over the columns shared with row j
+    count = observed_float @ observed_float.T
+    sums = values @ observed_float.T
+    squares = (values * values) @ observed_float.T
+    products = values @ values.T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = products - sums * sums.T / count
+        variance = squares - sums * sums / count
+        correlation = covariance / np.sqrt(variance * variance.T)
+    # variance left by floating point cancellation in constant rows is treated as no variance
+    has_variance = variance > 1e-12 * squares
+    defined = (count > 1) & has_variance & has_variance.T
+    return np.where(defined, np.clip(correlation, -1.0, 1.0), 0.0)
+
+
+def chromosome_correlation_lines(chromosome=None, positions=None, values=None, max_region_size=10000,
+                                 window_boundary=10000, decimals=2):
+    """Local correlation profile of every site on a chromosome in the RRBS-correlation_methylation_region.pl output
+    format, chromosome\tposition\tposition:correlation...\tC\tposition:correlation..., sites upstream of the site are
+    listed before C furthest first and downstream sites after C nearest first. Sites are split into windows with
+    kNNimputer.chromosome_imputation_chunks, using an inner boundary of at least max_region_size so every site within
+    max_region_size of a site is held in the window the site is assigned to, and each window is correlated at once
+    ----------------------------------------
+    input; chromosome, chromosome label
+    input; positions, sorted site positions
+    input; values, methylation values with sites as rows and samples as columns
+    input; max_region_size=10000, sites closer than max_region_size bp are correlated
+    input; window_boundary=10000, inner boundary of correlation windows, larger windows mean fewer larger matrices
+    input; decimals=2, decimal places written for each correlation
+    returns; output lines as a single string"""
+    positions = np.asarray(positions, dtype=np.int64)
+    boundary = max(max_region_size, window_boundary)
+    site_index = (np.zeros(len(positions), dtype=np.int32), np.asarray([chromosome], dtype=object), positions)
+    window_ranges, site_windows = kNNimputer.chromosome_imputation_chunks(None, imputation_distance=3 * boundary,
+                                                                          boundary=boundary, site_index=site_index)
+    entry_format = '%d:%.' + str(decimals) + 'f'
+    lines = []
+    window_breaks = np.flatnonzero(site_windows[1:] != site_windows[:-1]) + 1
+    for start_row, end_row in zip(np.concatenate(([0], window_breaks)),
+                                  np.concatenate((window_breaks, [len(site_windows)]))):
+        if end_row <= start_row:
+            continue
+        window_start, window_end = window_ranges[site_windows[start_row]]
+        window_positions = positions[window_start:window_end]
+        correlation = nan_correlation(values[window_start:window_end])
+        site_positions = positions[start_row:end_row]
+        lower_rows = np.searchsorted(window_positions, site_positions - max_region_size, side='right')
+        upper_rows = np.searchsorted(window_positions, site_positions + max_region_size, side='left')
+        for site_row, site_position, lower_row, upper_row in zip(range(start_row - window_start,
+                                                                       end_row - window_start),
+                                                                 site_positions, lower_rows, upper_rows):
+            site_correlation = correlation[site_row]
+            entries = [entry_format % (window_positions[row], site_correlation[row])
+                       for row in range(lower_row, site_row)]
+            entries.append('C')
+            entries.extend(entry_format % (window_positions[row], site_correlation[row])
+                           for row in range(site_row + 1, upper_row))
+            lines.append('\t'.join([str(chromosome), str(site_position)] + entries) + '\n')
+    return ''.join(lines)
+
+
+def chromosome_blocks(matrix_file=None, chunk_size=100000, separator='\t'):
+    """Read a methylation matrix one chromosome at a time
+    ----------------------------------------
+    input; matrix_file, sorted text matrix with header, chromosome\tposition\tsample1ratio..., may be gzipped, or a
+        binary matrix directory written by kNNimputer.save_binary or matrix_to_binary
+    yields; chromosome, positions, values"""
+    if os.path.isdir(matrix_file):
+        values, samples, row_labels, site_index = load_binary_matrix(matrix_file)
+        chromosome_codes, chromosomes, positions = site_index
+        chromosome_breaks = np.flatnonzero(chromosome_codes[1:] != chromosome_codes[:-1]) + 1
+        for start_row, end_row in zip(np.concatenate(([0], chromosome_breaks)),
+                                      np.concatenate((chromosome_breaks, [len(positions)]))):
+            if end_row > start_row:
+                yield chromosomes[chromosome_codes[start_row]], positions[start_row:end_row], values[start_row:end_row]
+        return
+    blocks = kNNimputer.read_matrix_blocks(matrix_file, chunk_size=chunk_size, separator=separator)
+    for chromosome, chromosome_chunk_blocks in groupby(blocks, key=lambda block: block[0]):
+        chromosome_chunk_blocks = list(chromosome_chunk_blocks)
+        yield (chromosome, np.concatenate([block[1] for block in chromosome_chunk_blocks]),
+               np.concatenate([block[2] for block in chromosome_chunk_blocks]))
+
+
+def correlation_regions(matrix_file=None, output_file=None, max_region_size=10000, window_boundary=10000, n_jobs=1,
+                        decimals=2, chunk_size=100000, separator='\t'):
+    """Python replacement for RRBS-correlation_methylation_region.pl, output is consumed by
+    RRBS-parse_correlation_methylation_region.pl. Chromosomes are processed in parallel and written in input order,
+    at most one chromosome per process is queued, so no more than n_jobs + 1 chromosomes are held in memory at a time
+    ----------------------------------------
+    input; matrix_file, sorted text matrix with header, chromosome\tposition\tsample1ratio..., may be gzipped, or a
+        binary matrix directory
+    input; output_file, path to write correlation profiles, gzipped if the name ends in .gz
+    input; max_region_size=10000, sites closer than max_region_size bp are correlated
+    input; window_boundary=10000, inner boundary of correlation windows
+    input; n_jobs=1, number of processes, None uses all available cores
+    input; decimals=2, decimal places written for each correlation, Statistics::Basic rounds to 2 places"""
+    options = {'max_region_size': max_region_size, 'window_boundary': window_boundary, 'decimals': decimals}
+    blocks = chromosome_blocks(matrix_file, chunk_size=chunk_size, separator=separator)
+    with (gzip.open(output_file, 'wt') if output_file.endswith('.gz') else open(output_file, 'w')) as output:
+        if n_jobs == 1:
+            for chromosome, positions, values in blocks:
+                print(chromosome)
+                output.write(chromosome_correlation_lines(chromosome, positions, values, **options))
+            return
+        processes = n_jobs or cpu_count()
+        with Pool(processes=processes) as pool:
+            pending = deque()
+            for chromosome, positions, values in blocks:
+                # write finished chromosomes, and wait for the oldest chromosome while every process has one queued
+                while pending and (len(pending) >= processes or pending[0][1].ready()):
+                    pending_chromosome, result = pending.popleft()
+                    print(pending_chromosome)
+                    output.write(result.get())
+                pending.append((chromosome, pool.apply_async(chromosome_correlation_lines,
+                                                             (chromosome, positions, np.asarray(values)), options)))
+            while pending:
+                chromosome, result = pending.popleft()
+                print(chromosome)
+                output.write(result.get())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local correlation of cytosine methylation for every cytosine, '
+                                                 'output is parsed into regions by '
+                                                 'RRBS-parse_correlation_methylation_region.pl')
+    parser.add_argument('--matrix_file', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--max_region_size', type=int, default=10000)
+    parser.add_argument('--window_boundary', type=int, default=10000)
+    parser.add_argument('--n_jobs', type=int, default=1)
+    parser.add_argument('--decimals', type=int, default=2)
+    arguments = parser.parse_args()
+    correlation_regions(matrix_file=arguments.matrix_file, output_file=arguments.output,
+                        max_region_size=arguments.max_region_size, window_boundary=arguments.window_boundary,
+                        n_jobs=arguments.n_jobs, decimals=arguments.decimals)
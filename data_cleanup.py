@@ -1,37 +1,126 @@
 #! /usr/env python3
 
+from functools import lru_cache
 import numpy as np
 import pandas as pd
 import scipy.stats as stats
 from sklearn import preprocessing
+from binary_matrix import load_binary_matrix
+from binary_matrix import write_binary_matrix
 
 
 class DataCleanup:
     """Note! This class is designed for use with phenotype data, to normalize information for feature selection. Whole,
     data table will be loaded into memory so this is not suitable for extremely large data sets"""
 
-    def __init__(self, file, separator, header=True, named_rows=True):
+    def __init__(self, file, separator, header=True, named_rows=True, chunk_size=None, dtype=np.float64, columns=None,
+                 rows=None, column_missing_value_tolerance=None, row_missing_value_tolerance=None):
         """Simple dataframe import for normalization and data cleaning
         ---------------------------------------------
         file = file to import, csv or tsv
         separator = file feature used to designate columns
         header = True: if true header will be imported as the first row
         named_rows = True: first column represents row names
-        missing_value_representation = how missing values are represented in the data table, default is blank"""
-        if header and named_rows:
-            imported_data_frame = pd.DataFrame.from_csv(file, sep=separator, header=0, index_col=0)
-        elif header and not named_rows:
-            imported_data_frame = pd.DataFrame.from_csv(file, sep=separator, header=0)
-        elif not header and named_rows:
-            imported_data_frame = pd.DataFrame.from_csv(file, sep=separator, index_col=0)
-        else:
-            imported_data_frame = pd.DataFrame.from_csv(file, sep=separator)
-        self.df = imported_data_frame
+        missing_value_representation = how missing values are represented in the data table, default is blank
+        chunk_size = None: if set, or if any of the following options are set, the file is loaded in chunks with
+            load_numeric_chunks so values are numeric as loaded and dropped traits are never held in memory
+        dtype = np.float64: numeric type for chunked loading, np.float32 halves memory
+        columns = None: list of columns to load, all columns if None
+        rows = None: list of rows to load, all rows if None
+        column_missing_value_tolerance = None: remove_low_information_columns tolerance applied while loading
+        row_missing_value_tolerance = None: remove_low_information_rows tolerance applied while loading"""
         self.dropped_row_index = None
         self.dropped_categories = None
+        chunked_options = (columns, rows, column_missing_value_tolerance, row_missing_value_tolerance)
+        if chunk_size is None and all(option is None for option in chunked_options):
+            self.df = pd.read_csv(file, sep=separator, header=0 if header else None,
+                                  index_col=0 if named_rows else None)
+        else:
+            self.df, self.dropped_row_index, self.dropped_categories = DataCleanup.load_numeric_chunks(
+                file, separator, header=header, named_rows=named_rows, chunk_size=chunk_size or 100000,
+                dtype=dtype, columns=columns, rows=rows, column_missing_value_tolerance=column_missing_value_tolerance,
+                row_missing_value_tolerance=row_missing_value_tolerance)
+
+    @classmethod
+    def from_binary(cls, path, mmap_mode='r'):
+        """Load a dataframe saved with save_binary, values are memory mapped rather than parsed
+        ---------------------------------------------
+        path = binary matrix directory
+        mmap_mode = 'r': np.memmap mode, 'c' for copy on write values that can be edited in memory"""
+        values, columns, rows, site_index = load_binary_matrix(path, mmap_mode=mmap_mode)
+        data_cleanup = cls.__new__(cls)
+        data_cleanup.df = pd.DataFrame(values, index=rows, columns=columns, copy=False)
+        data_cleanup.dropped_row_index = None
+        data_cleanup.dropped_categories = None
+        return data_cleanup
+
+    @staticmethod
+    def read_numeric_chunks(file, separator, header=True, named_rows=True, chunk_size=100000, dtype=np.float64,
+                            columns=None, rows=None):
+        """Read a csv or tsv file in numeric chunks, gzip compression is inferred from the file name. Non-numeric
+        values are coerced to np.nan as each chunk is parsed.
+        ---------------------------------------------
+        columns = None: list of columns to read, requires a header
+        rows = None: list of rows to keep, requires named rows
+        yields; numeric dataframe chunks"""
+        use_columns = None
+        if columns is not None:
+            if not header:
+                raise ValueError('Column selection requires a header')
+            file_columns = list(pd.read_csv(file, sep=separator, header=0, nrows=0))
+            selected_columns = set(columns)
+            # index_col is relative to the selected columns, keep the row name column first
+            use_columns = [position for position, column in enumerate(file_columns)
+                           if column in selected_columns or (named_rows and position == 0)]
+        if rows is not None and not named_rows:
+            raise ValueError('Row selection requires named rows')
+        reader = pd.read_csv(file, sep=separator, header=0 if header else None, index_col=0 if named_rows else None,
+                             usecols=use_columns, chunksize=chunk_size)
+        for chunk in reader:
+            if rows is not None:
+                chunk = chunk[chunk.index.isin(rows)]
+            # numeric columns are parsed by the csv reader, only coerce columns read as objects
+            non_numeric_columns = chunk.columns[[not pd.api.types.is_numeric_dtype(column_type)
+                                                 for column_type in chunk.dtypes]]
+            for column in non_numeric_columns:
+                chunk[column] = pd.to_numeric(chunk[column], errors='coerce')
+            yield chunk.astype(dtype)
 
     @staticmethod
-    def rank_based_inv_norm(x, c=0):
+    def load_numeric_chunks(file, separator, header=True, named_rows=True, chunk_size=100000, dtype=np.float64,
+                            columns=None, rows=None, column_missing_value_tolerance=None,
+                            row_missing_value_tolerance=None):
+        """Load a numeric dataframe in chunks, applying remove_low_information_columns and remove_low_information_rows
+        as streaming passes. Column tolerance needs a counting pass over the file before loading so low information
+        columns are never loaded, columns are filtered before rows.
+        ---------------------------------------------
+        returns; dataframe, dropped row labels, and numeric proportion of kept columns (None if not filtered)"""
+        numeric_proportion = None
+        if column_missing_value_tolerance is not None:
+            numeric_count, row_count = None, 0
+            for chunk in DataCleanup.read_numeric_chunks(file, separator, header=header, named_rows=named_rows,
+                                                         chunk_size=chunk_size, dtype=dtype, columns=columns,
+                                                         rows=rows):
+                chunk_count = chunk.count(axis=0)
+                numeric_count = chunk_count if numeric_count is None else numeric_count + chunk_count
+                row_count += len(chunk.index)
+            numeric_proportion = numeric_count / row_count
+            numeric_proportion = numeric_proportion[numeric_proportion > column_missing_value_tolerance]
+            columns = numeric_proportion.index.tolist()
+        chunks = []
+        dropped_row_index = [] if row_missing_value_tolerance is not None else None
+        for chunk in DataCleanup.read_numeric_chunks(file, separator, header=header, named_rows=named_rows,
+                                                     chunk_size=chunk_size, dtype=dtype, columns=columns, rows=rows):
+            if row_missing_value_tolerance is not None:
+                row_proportion = chunk.count(axis=1) / len(chunk.columns)
+                dropped_row_index.extend(row_proportion.index[row_proportion < row_missing_value_tolerance])
+                chunk = chunk[(row_proportion >= row_missing_value_tolerance).values]
+            chunks.append(chunk)
+        data_frame = pd.concat(chunks) if chunks else pd.DataFrame(columns=columns, dtype=dtype)
+        return data_frame, dropped_row_index, numeric_proportion
+
+    @staticmethod
+    def rank_based_inv_norm(x, c=0, axis=0):
         """
         Perform the rank-based inverse normal transformation on data x.
 
@@ -41,9 +130,36 @@ class DataCleanup:
 
         :param x: input array-like
         :param c: constant parameter
+        :param axis: axis to rank along, columns are transformed independently for 2-D input
         :return: y
         """
-        return stats.norm.ppf((stats.rankdata(x) + c) / (x.size - 2 * c + 1))
+        x = np.asarray(x)
+        return stats.norm.ppf((stats.rankdata(x, axis=axis) + c) / (x.shape[axis] - 2 * c + 1))
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def normal_threshold(test_length, normal_test=1000, normal_percentile=0.01, seed=None):
+        """Normality test p-value threshold from random normal samples, memoized as the threshold only depends on the
+        arguments
+        ---------------------------------------------
+        test_length; length of each random sample, the number of rows in the data
+        normal_test=1000; number of random samples scored for normality
+        normal_percentile=0.01; percentile of the random sample p-value distribution used as the threshold
+        seed=None; seed for the random samples"""
+        random_generator = np.random.default_rng(seed)
+        test_scores = []
+        # score random samples in batches of columns with a single normaltest call, limit each batch to ~160MB
+        batch_size = max(1, int(2e7 // max(test_length, 1)))
+        for batch_start in range(0, normal_test, batch_size):
+            # generate random distributions with a mean of 0 and stdev of 1
+            random_normal = random_generator.normal(loc=0, scale=1,
+                                                    size=(test_length, min(batch_size, normal_test - batch_start)))
+            chi_squared_stat, two_sided_chi_p_value = stats.normaltest(random_normal, axis=0)
+            test_scores.append(two_sided_chi_p_value)
+        test_scores = np.sort(np.concatenate(test_scores))
+        # set normal threshold
+        percentile_cutoff_index = int(round(normal_percentile * len(test_scores)))
+        return test_scores[percentile_cutoff_index]
 
     def list_column_removal(self, removal_list=None):
         """Removes columns supplied in list
@@ -112,36 +228,31 @@ class DataCleanup:
         # Re-initialize dataframe with imputed data
         self.df = pd.DataFrame(imputed_data_frame, index=list(self.df.index), columns=list(self.df))
 
-    def normal_transformation(self, normal_test=1000, normal_percentile=0.01):
+    def normal_transformation(self, normal_test=1000, normal_percentile=0.01, seed=None):
         """Perform a test of normality, if the test is below threshold perform rank based inverse transformation. If
         above threshold, standardize data with a mean of 0 and stdev of 1.
         ---------------------------------------------
         normal_tests=1000, sets the probability cutoff normal distributions by generating random samples of the length
             of the input data and scoring them for normality, default is 1000 random samples
         normal_percentile=0.1, percentile in the distribution to used to set your normal distribution threshold before
-            transformation"""
-        # generate randomly sampled data from normal distribution and score for normality
-        # storage list
-        test_scores = []
-        # generate random distribution the same length as the input data
-        test_length = len(list(self.df.index))
-        for _ in range(normal_test):
-            # generate random distributions with a mean of 0 and stdev of 1
-            random_normal = np.random.normal(loc=0, scale=1, size=test_length)
-            chi_squared_stat, two_sided_chi_p_value = stats.normaltest(random_normal)
-            test_scores.append(two_sided_chi_p_value)
-        test_scores.sort()
-        # set normal threshold
-        percentile_cutoff_index = int(round(normal_percentile * len(test_scores)))
-        normal_threshold = test_scores[percentile_cutoff_index]
-        for column in list(self.df):
-            # preform scipy.stats.normaltest
-            chi_squared_stat, two_sided_chi_p_value = stats.normaltest(self.df[column])
-            # if distribution score below threshold rank based inverse normal transformation else scale (mean=0, std=1)
-            if two_sided_chi_p_value <= normal_threshold:
-                self.df[column] = DataCleanup.rank_based_inv_norm(self.df[column])
-            else:
-                self.df[column] = preprocessing.scale(self.df[column])
+            transformation
+        seed=None, seed for the random samples, the threshold is memoized for each row count and setting"""
+        normal_threshold = DataCleanup.normal_threshold(len(self.df.index), normal_test, normal_percentile, seed)
+        values = self.df.to_numpy(dtype=np.float64)
+        # preform scipy.stats.normaltest on every column at once
+        chi_squared_stat, two_sided_chi_p_value = stats.normaltest(values, axis=0)
+        # if distribution score below threshold rank based inverse normal transformation else scale (mean=0, std=1)
+        rank_columns = two_sided_chi_p_value <= normal_threshold
+        transformed_values = np.empty_like(values)
+        if np.any(rank_columns):
+            transformed_values[:, rank_columns] = DataCleanup.rank_based_inv_norm(values[:, rank_columns], axis=0)
+        if not np.all(rank_columns):
+            scale_values = values[:, ~rank_columns]
+            column_std = np.nanstd(scale_values, axis=0)
+            # constant columns are centered but not scaled, matching preprocessing.scale
+            column_std[column_std == 0] = 1.0
+            transformed_values[:, ~rank_columns] = (scale_values - np.nanmean(scale_values, axis=0)) / column_std
+        self.df = pd.DataFrame(transformed_values, index=self.df.index, columns=self.df.columns)
 
     def remove_low_variance_features(self, variance_threshold=0.0):
         """This function should only be called on normalized and imputed dataframe, drop columns with
@@ -159,3 +270,10 @@ class DataCleanup:
         output_path=None: path to export file
         separator=None: whitespace indicator"""
         self.df.to_csv(path_or_buf=output_path, sep=separator, header=True, index=True)
+
+    def save_binary(self, output_path=None, dtype=np.float32):
+        """Export dataframe as a binary matrix directory loaded with from_binary, values must be numeric
+        ---------------------------------------------
+        output_path=None: directory to write
+        dtype=np.float32: value type of the saved value block"""
+        write_binary_matrix(output_path, [(self.df.index, self.df.values)], self.df.columns, dtype=dtype)
@@ -1,256 +1,1257 @@
 #! /usr/env python3
 
+from collections import deque
+from contextlib import contextmanager
+from contextlib import nullcontext
+import gzip
+import hashlib
+import json
+from itertools import groupby
+from multiprocessing import cpu_count
+from multiprocessing import Pool
+from multiprocessing import shared_memory
 import numpy as np
+import os
 import pandas as pd
-import random
+import shutil
+import tempfile
+from threadpoolctl import threadpool_limits
+import time
+import tracemalloc
+from binary_matrix import load_binary_matrix
+from binary_matrix import write_binary_matrix
+
+
+# pairwise distance backends selected with the kNNimputer distance argument, 'euclidean' computes exact NaN aware
+# distances, 'approximate' searches random projection sketches and re-ranks candidates with exact distances
+DISTANCE_BACKENDS = ('euclidean', 'approximate')
+
+# per process window state, set by _init_window_worker so the methylation matrix is attached from shared memory
+# rather than pickled with every window
+_window_state = {}
+
+
+def _init_window_worker(shared_name=None, shape=None, dtype=None, global_neighbors=None, k=None, incremental=False,
+                        distance='euclidean', approximate_options=None, profile_windows=False, trace_memory=False):
+    """Attach worker process to shared methylation values"""
+    # each process already works on its own windows, a BLAS thread pool per process would oversubscribe the cores
+    _window_state['threadpool_limits'] = threadpool_limits(limits=1)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    shared_values = shared_memory.SharedMemory(name=shared_name)
+    _window_state['shared_values'] = shared_values
+    _window_state['values'] = np.ndarray(shape, dtype=dtype, buffer=shared_values.buf)
+    _window_state['global_neighbors'] = global_neighbors
+    _window_state['k'] = k
+    _window_state['incremental'] = incremental
+    _window_state['distance'] = distance
+    _window_state['approximate_options'] = approximate_options
+    _window_state['profile_windows'] = profile_windows
+
+
+def _window_worker(row_ranges):
+    """Pairwise distance and nearest neighbors for a batch of consecutive (start_row, end_row) windows, with the
+    window_callback records of the batch if windows are profiled"""
+    window_records = []
+    window_results = kNNimputer.window_batch_distance_neighbors(
+        _window_state['values'], row_ranges, global_neighbors=_window_state['global_neighbors'], k=_window_state['k'],
+        incremental=_window_state['incremental'], distance=_window_state['distance'],
+        approximate_options=_window_state['approximate_options'],
+        window_callback=(lambda *window_record: window_records.append(window_record))
+        if _window_state['profile_windows'] else None)
+    return window_results, window_records
+
+
+def _start_window_timer():
+    """Start timing a window for a window_callback, the traced memory peak is reset so it covers only the window"""
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+    return time.perf_counter()
+
+
+def _report_window(window_callback, start_row, end_row, start_time):
+    """Pass wall time and traced peak memory of a window timed with _start_window_timer to a window_callback"""
+    peak_memory = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None
+    window_callback(start_row, end_row, time.perf_counter() - start_time, peak_memory)
+
+
+def _profile_stage(profile=None, name=None, sites=None, samples=None):
+    """RunProfile.stage context, or an empty context if the run is not profiled"""
+    if profile is None:
+        return nullcontext()
+    return profile.stage(name, sites=sites, samples=samples)
+
+
+class RunProfile:
+    """Wall time, site count, sample count and peak memory of each stage and each window of kNNimputer.run. Pass an
+    instance as the run profile argument, unprofiled runs skip all instrumentation. Peak memory is traced with
+    tracemalloc, which slows down allocation, set trace_memory=False to record only wall time. With n_jobs > 1 window
+    peak memory is traced in the worker processes and stage peak memory covers only the main process"""
+
+    def __init__(self, progress=True, progress_interval=10.0, trace_memory=True):
+        """--------------------------
+        input; progress=True, print window progress with an estimated time remaining
+        input; progress_interval=10.0, minimum number of seconds between progress lines
+        input; trace_memory=True, record peak memory with tracemalloc"""
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.windows = []
+        self.window_chromosomes = None
+        self.window_offset = 0
+        self.window_samples = None
+        self.windows_start_time = None
+        self.last_progress_time = None
+        self.stage_window_peak = 0
+
+    @contextmanager
+    def stage(self, name=None, sites=None, samples=None):
+        """Record wall time and peak memory of the code run in the context as a stage"""
+        start_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        self.stage_window_peak = 0
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start_time
+            peak_memory = None
+            if self.trace_memory:
+                # windows reset the traced peak, so the stage peak is the largest of the window peaks and the peak
+                # traced after the last window
+                peak_memory = max(tracemalloc.get_traced_memory()[1], self.stage_window_peak) / 1024 ** 2
+            if start_tracing:
+                tracemalloc.stop()
+            self.stages.append({'stage': name, 'sites': sites, 'samples': samples, 'wall_time': wall_time,
+                                'peak_memory_mb': peak_memory})
+
+    def start_windows(self, window_chromosomes=None, samples=None):
+        """Set the windows reported with add_window, may be called again for each chromosome of a checkpointed run
+        --------------------------
+        input; window_chromosomes, chromosome label of each window in window order
+        input; samples, number of samples in each window"""
+        self.window_chromosomes = window_chromosomes
+        self.window_samples = samples
+        self.window_offset = len(self.windows)
+        self.windows_start_time = time.perf_counter()
+        self.last_progress_time = self.windows_start_time
+
+    def add_window(self, start_row=None, end_row=None, wall_time=None, peak_memory=None):
+        """window_callback recording the next window in window order, prints progress every progress_interval"""
+        window = len(self.windows) - self.window_offset
+        if peak_memory is not None:
+            self.stage_window_peak = max(self.stage_window_peak, peak_memory)
+        self.windows.append({'window': len(self.windows), 'chromosome': str(self.window_chromosomes[window]),
+                             'start_row': int(start_row), 'end_row': int(end_row), 'sites': int(end_row - start_row),
+                             'samples': self.window_samples, 'wall_time': wall_time,
+                             'peak_memory_mb': None if peak_memory is None else peak_memory / 1024 ** 2})
+        if self.progress:
+            current_time = time.perf_counter()
+            completed = window + 1
+            window_count = len(self.window_chromosomes)
+            if current_time - self.last_progress_time >= self.progress_interval or completed == window_count:
+                self.last_progress_time = current_time
+                elapsed = current_time - self.windows_start_time
+                remaining = elapsed / completed * (window_count - completed)
+                print('Windows %d/%d (%.1f%%), chromosome %s, elapsed %.1fs, ETA %.1fs' %
+                      (completed, window_count, 100.0 * completed / window_count, self.window_chromosomes[window],
+                       elapsed, remaining))
+
+    def summary(self):
+        """Profile as a dict of stage records, window records and window totals for each chromosome"""
+        chromosomes = {}
+        for window_record in self.windows:
+            chromosome = chromosomes.setdefault(window_record['chromosome'], {'windows': 0, 'sites': 0,
+                                                                               'wall_time': 0.0})
+            chromosome['windows'] += 1
+            chromosome['sites'] += window_record['sites']
+            chromosome['wall_time'] += window_record['wall_time']
+        return {'stages': self.stages, 'chromosomes': chromosomes, 'windows': self.windows,
+                'wall_time': sum(stage['wall_time'] for stage in self.stages)}
+
+    def dump(self, output_path=None):
+        """Write the profile summary as json"""
+        with open(output_path, 'w') as output:
+            json.dump(self.summary(), output, indent=1)
+
+
+class DistanceCache:
+    """On disk cache of global and window distance matrices stored as .npy files and loaded as memmaps. Entries are
+    keyed by a content hash of the methylation matrix and the window parameters, least recently used entries are
+    evicted once the cache directory is larger than max_bytes"""
+
+    def __init__(self, cache_dir=None, max_bytes=10 * 1024 ** 3):
+        """--------------------------
+        input; cache_dir, directory to store cached arrays, created if missing
+        input; max_bytes=10GB, size bound of the cache directory"""
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def matrix_hash(dataframe, site_index=None, block_bytes=64 * 1024 ** 2):
+        """Content hash of a methylation dataframe, values, site labels and sample labels, site_index replaces the site
+        labels of binary matrices indexed by row number. Values are hashed in their stored type a block of rows at a
+        time, so memory mapped matrices are never read into memory at once"""
+        digest = hashlib.sha256()
+        values = dataframe.values
+        digest.update((str(values.shape) + values.dtype.str).encode())
+        block_rows = max(1, block_bytes // max(values.itemsize * values.shape[1], 1))
+        for start_row in range(0, values.shape[0], block_rows):
+            digest.update(memoryview(np.ascontiguousarray(values[start_row:start_row + block_rows])).cast('B'))
+        if site_index is not None:
+            chromosome_codes, chromosomes, positions = site_index
+            digest.update(memoryview(np.ascontiguousarray(chromosome_codes, dtype=np.int32)).cast('B'))
+            digest.update(memoryview(np.ascontiguousarray(positions, dtype=np.int64)).cast('B'))
+            digest.update('\n'.join(str(chromosome) for chromosome in chromosomes).encode())
+        else:
+            digest.update('\n'.join(str(label) for label in dataframe.index).encode())
+        digest.update('\n'.join(str(label) for label in dataframe.columns).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        """Cache key from a matrix hash and any parameters the cached arrays depend on"""
+        return hashlib.sha256('|'.join(str(part) for part in parts).encode()).hexdigest()[:32]
+
+    def path(self, key, name):
+        return os.path.join(self.cache_dir, key + '.' + name + '.npy')
+
+    def load(self, key, names):
+        """Load cached arrays as read only memmaps
+        --------------------------
+        returns; dict linking array name to array, None if any array is missing"""
+        paths = [self.path(key, name) for name in names]
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        arrays = {name: np.load(path, mmap_mode='r') for name, path in zip(names, paths)}
+        # mark entry as recently used for eviction
+        for path in paths:
+            os.utime(path)
+        return arrays
+
+    def save(self, key, arrays):
+        """Save arrays to the cache then evict least recently used entries over the size bound
+        --------------------------
+        input; arrays, dict linking array name to an array, or to a list of equal shape arrays that are written to a
+            single stacked array without stacking in memory"""
+        for name, array in arrays.items():
+            path = self.path(key, name)
+            # unique temporary file so concurrent runs saving the same entry do not write over each other
+            temporary_file, temporary_path = tempfile.mkstemp(dir=self.cache_dir, prefix=key + '.' + name + '.',
+                                                              suffix='.tmp.npy')
+            os.close(temporary_file)
+            if isinstance(array, list):
+                shape = (len(array),) + (np.shape(array[0]) if array else ())
+                stacked = np.lib.format.open_memmap(temporary_path, mode='w+', dtype=np.float64, shape=shape)
+                for count, window_array in enumerate(array):
+                    stacked[count] = window_array
+                stacked.flush()
+                del stacked
+            else:
+                np.save(temporary_path, np.asarray(array))
+            os.replace(temporary_path, path)
+        self.evict(keep_key=key)
+
+    def evict(self, keep_key=None):
+        """Remove least recently used entries until the cache is within max_bytes"""
+        entries = {}
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith('.npy') or file_name.endswith('.tmp.npy'):
+                continue
+            file_path = os.path.join(self.cache_dir, file_name)
+            file_stat = os.stat(file_path)
+            entry = entries.setdefault(file_name.split('.')[0], [0, 0, []])
+            entry[0] += file_stat.st_size
+            entry[1] = max(entry[1], file_stat.st_mtime)
+            entry[2].append(file_path)
+        cache_size = sum(entry[0] for entry in entries.values())
+        for entry_key, (entry_size, entry_time, entry_paths) in sorted(entries.items(), key=lambda item: item[1][1]):
+            if cache_size <= self.max_bytes:
+                break
+            if entry_key == keep_key:
+                continue
+            for file_path in entry_paths:
+                os.remove(file_path)
+            cache_size -= entry_size
 
 
 class kNNimputer:
 
-    def __init__(self, dataframe=None, distance='euclidean'):
+    def __init__(self, dataframe=None, distance='euclidean', sketch_size=64, candidate_factor=8, random_state=None,
+                 site_index=None):
+        """kNN imputation over sliding genome windows
+        --------------------------
+        input; dataframe, methylation values with sites as rows and samples as columns
+        input; distance='euclidean', neighbor backend, 'euclidean' for exact distances or 'approximate' for random
+            projection candidate search with exact re-ranking, suited to several thousand samples
+        input; sketch_size=64, number of random projections used by the approximate backend
+        input; candidate_factor=8, recall knob for the approximate backend, k * candidate_factor candidates are
+            re-ranked with exact distances, larger values trade speed for recall
+        input; random_state=None, seed for the approximate backend projections
+        input; site_index=None, (chromosome_codes, chromosomes, positions) of each row as returned by
+            parse_site_labels, used in place of the row labels, set by from_binary"""
+        if distance not in DISTANCE_BACKENDS:
+            raise ValueError('distance must be one of ' + ', '.join(DISTANCE_BACKENDS))
         self.df = dataframe
         self.distance = distance
+        self.approximate_options = {'sketch_size': sketch_size, 'candidate_factor': candidate_factor,
+                                    'random_state': random_state}
         self.row_labels = self.df.index
+        self.site_index = site_index
         self.samples = list(self.df)
         self.values = np.transpose(self.df.values)
         self.distance_matrix = None
-        self.chromosome_pairwise_dict = None
-        self.neighbor_dicts = None
+        self.window_ranges = None
+        self.site_windows = None
+        self.neighbors = None
+        self.neighbor_distances = None
 
     def run(self, imputation_dist=6000000, boundary_dist=2000000, k=5,
-            missing_value_tolerance=0.0, variance_tolerance=None):
-        print('Getting Global Neighbors')
-        global_neighbors = kNNimputer.euclidean(self.values)
-        print('Processing Windows')
-        self.chromosome_pairwise_windows(imputation_dist=imputation_dist,
-                                         boundary_dist=boundary_dist,
-                                         global_neighbors=global_neighbors)
-        print('Getting ' + str(k) + ' Nearest Neighbors')
-        self.get_nearest_neighbors(k=k)
+            missing_value_tolerance=0.0, variance_tolerance=None, n_jobs=1, weighted=False, incremental=False,
+            cache_dir=None, cache_size=10 * 1024 ** 3, profile=None, checkpoint_dir=None):
+        """Impute missing values, if cache_dir is set global and window distance matrices of the exact backend are
+        cached on disk so later runs changing only k or tolerances skip all distance computation. If profile is set to
+        a RunProfile wall time and peak memory are recorded for the global_distances, window_index, window_neighbors
+        and imputation stages and for every window. If checkpoint_dir is set chromosomes are imputed one at a time
+        with checkpointed_imputation, window distances are then not cached"""
+        sites, samples = self.df.shape
+        global_neighbors = None
+        cache, matrix_hash = None, None
+        if cache_dir is not None and self.distance == 'euclidean':
+            cache = DistanceCache(cache_dir, max_bytes=cache_size)
+            matrix_hash = DistanceCache.matrix_hash(self.df, site_index=self.site_index)
+        # the approximate backend avoids the dense global matrix, falling back to sketch distances instead
+        if self.distance == 'euclidean':
+            print('Getting Global Neighbors')
+            with _profile_stage(profile, 'global_distances', sites=sites, samples=samples):
+                global_key = DistanceCache.key(matrix_hash, 'global') if cache else None
+                cached = cache.load(global_key, ['global']) if cache else None
+                if cached is not None:
+                    global_neighbors = np.asarray(cached['global'])
+                else:
+                    global_neighbors = kNNimputer.euclidean(self.values)
+                    if cache:
+                        cache.save(global_key, {'global': global_neighbors})
+        if checkpoint_dir is not None:
+            self.checkpointed_imputation(checkpoint_dir=checkpoint_dir, imputation_dist=imputation_dist,
+                                         boundary_dist=boundary_dist, global_neighbors=global_neighbors, k=k,
+                                         missing_value_tolerance=missing_value_tolerance,
+                                         variance_tolerance=variance_tolerance, n_jobs=n_jobs, weighted=weighted,
+                                         incremental=incremental, profile=profile)
+            return
+        print('Processing Windows, Getting ' + str(k) + ' Nearest Neighbors')
+        window_key = DistanceCache.key(matrix_hash, 'windows', imputation_dist, boundary_dist) if cache else None
+        cached = cache.load(window_key, ['distances', 'window_ranges', 'site_windows']) if cache else None
+        if cached is not None:
+            with _profile_stage(profile, 'window_neighbors', sites=sites, samples=samples):
+                self.distance_matrix = list(cached['distances'])
+                self.window_ranges = np.asarray(cached['window_ranges'])
+                self.site_windows = np.asarray(cached['site_windows'])
+                self.get_nearest_neighbors(k=k)
+        else:
+            self.chromosome_pairwise_windows(imputation_dist=imputation_dist,
+                                             boundary_dist=boundary_dist,
+                                             global_neighbors=global_neighbors,
+                                             k=k, n_jobs=n_jobs, incremental=incremental, profile=profile)
+            if cache:
+                cache.save(window_key, {'distances': self.distance_matrix, 'window_ranges': self.window_ranges,
+                                        'site_windows': self.site_windows})
         print('Imputing Missing Values')
-        self.nearest_neighbor_imputation(missing_value_tolerance=missing_value_tolerance,
-                                         variance_tolerance=variance_tolerance)
+        with _profile_stage(profile, 'imputation', sites=sites, samples=samples):
+            self.nearest_neighbor_imputation(missing_value_tolerance=missing_value_tolerance,
+                                             variance_tolerance=variance_tolerance, weighted=weighted)
 
     @staticmethod
-    def euclidean(array=None, global_neighbors=None):
-        """ Pairwise euclidean distance
+    def euclidean(array=None, global_neighbors=None, block_bytes=16 * 1024 ** 2):
+        """ Pairwise euclidean distance, NaN values are dropped pairwise between samples so each distance is
+        calculated only over the sites observed in both samples. Statistics are accumulated over blocks of sites so
+        memory depends on block size rather than the number of sites
         ----------------------------------------
         input: numpy array with samples as rows
+        input: global_neighbors=None, distance array used when a sample pair shares no observed sites
+        input: block_bytes=16MB, size of each float64 temporary built for a block of sites
         output: pairwise euclidean distance array"""
-        # split numpy array by columns
-        methylation_samples = np.split(array, 1)
-        # output to ensure correct matrix orientation
-        # initialize empty list to hold pairwise distance values
-        pairwise_distance = []
-        # iterate through sample combinations
-        for count, methylation_vector in enumerate(methylation_samples[0]):
-            # add list for all sample pairwise comparison
-            pairwise_distance.append([])
-            for comparison_count, comparison_vector in enumerate(methylation_samples[0]):
-                # only perform calculation for upper half of distance matrix to save time
-                if comparison_count >= count:
-                    # stack sample values
-                    comparison_array = np.stack((methylation_vector, comparison_vector), axis=0)
-                    # drop any comparison value with NA for any sample, note this is only done pairwise between
-                    # samples to get best distance comparison estimate
-                    comparison_array = np.ma.compress_cols(np.ma.masked_invalid(comparison_array))
-                    try:
-                        pairwise_distance[count].append(np.linalg.norm(comparison_array[0] - comparison_array[1]))
-                    # if all values are missing the missing neighbor is close,
-                    except IndexError:
-                        if global_neighbors:
-                            pairwise_distance[count].append(global_neighbors[count][comparison_count])
-                        else:
-                            pairwise_distance[count].append(0)
-                else:
-                    pairwise_distance[count].append(0)
-        # add upper and lower matrices
-        pairwise_upper = np.asarray(pairwise_distance)
-        pairwise_lower = np.transpose(pairwise_upper)
-        # return list to ensure compatibility with downstream tools
-        pairwise_distance = (pairwise_upper + pairwise_lower).tolist()
+        array = np.asanyarray(array)
+        sample_count, site_count = array.shape
+        block_sites = max(1, block_bytes // (8 * max(sample_count, 1)))
+        squared_distance = np.zeros((sample_count, sample_count))
+        overlap = np.zeros((sample_count, sample_count))
+        for start_site in range(0, site_count, block_sites):
+            block_squared_distance, block_overlap = kNNimputer.euclidean_statistics(
+                array[:, start_site:start_site + block_sites])
+            squared_distance += block_squared_distance
+            overlap += block_overlap
+        return kNNimputer.statistics_distance(squared_distance, overlap, global_neighbors=global_neighbors)
+
+    @staticmethod
+    def euclidean_statistics(array=None):
+        """Pairwise sufficient statistics for NaN aware euclidean distance. Statistics are additive over sites so
+        distances can be accumulated over chunks of a matrix
+        ----------------------------------------
+        input: numpy array with samples as rows
+        output: squared_distance, sum of squared differences over sites observed in both samples
+        output: overlap, count of sites observed in both samples"""
+        array = np.asarray(array, dtype=np.float64)
+        # observed value mask and values with missing entries zeroed out
+        observed = ~np.isnan(array)
+        observed_float = observed.astype(np.float64)
+        values = np.where(observed, array, 0.0)
+        squared_values = values * values
+        # ||x - y||^2 over pairwise observed sites expanded as sum(x^2) + sum(y^2) - 2 * x.y, each sum restricted to
+        # the sites observed in the partner sample
+        squared_distance = squared_values @ observed_float.T
+        squared_distance += squared_distance.T
+        squared_distance -= 2.0 * (values @ values.T)
+        overlap = observed_float @ observed_float.T
+        return squared_distance, overlap
+
+    @staticmethod
+    def statistics_distance(squared_distance, overlap, global_neighbors=None):
+        """Pairwise euclidean distance from sufficient statistics returned by euclidean_statistics
+        ----------------------------------------
+        input: global_neighbors=None, distance array used when a sample pair shares no observed sites
+        output: pairwise euclidean distance array"""
+        # remove negative values introduced by floating point cancellation
+        pairwise_distance = np.sqrt(np.maximum(squared_distance, 0.0))
+        # if all values are missing for a sample pair fall back to global distance, otherwise the neighbor is close
+        no_overlap = overlap == 0
+        if np.any(no_overlap):
+            if global_neighbors is not None:
+                pairwise_distance[no_overlap] = np.asarray(global_neighbors)[no_overlap]
+            else:
+                pairwise_distance[no_overlap] = 0
+        np.fill_diagonal(pairwise_distance, 0)
         return pairwise_distance
 
     @staticmethod
-    def chromosome_imputation_chunks(site_labels, imputation_distance=3000000, boundary=1000000):
+    def parse_site_labels(site_labels):
+        """Parse site labels once into integer arrays
+        --------------------------
+        input; site_labels, list of chromosome labels, chr1 or 1, with : separating genome coordinates, ie 1:100000
+        returns; chromosome_codes, int32 array coding chromosomes in order of first appearance
+        returns; chromosomes, array of chromosome labels indexed by chromosome code
+        returns; positions, int64 array of site positions"""
+        site_split = pd.Index(site_labels).astype(str).str.split(':', n=1, expand=True)
+        chromosome_codes, chromosomes = pd.factorize(site_split.get_level_values(0))
+        positions = np.asarray(site_split.get_level_values(1), dtype=np.int64)
+        return chromosome_codes.astype(np.int32), np.asarray(chromosomes), positions
+
+    @staticmethod
+    def chromosome_imputation_chunks(site_labels, imputation_distance=3000000, boundary=1000000, site_index=None):
         """Segments chromosome inputs into discreet chunks for imputation. Three overlapping windows traverse the
         genome. Sites are assigned to imputation window if they reside in the middle section of the relevant imputation
         window. Sites at beginning or end of a chromosome are assigned to the first or last window accordingly even
-        though the site is outside the window inner boundary.
+        though the site is outside the window inner boundary. Sites must be sorted by chromosome and position, each
+        window is a contiguous range of rows.
         --------------------------
         input; site_labels, list of chromosome labels, chr1 or 1, with : separating genome coordinates, ie 1:100000
         input; imputation_distance=3000000, size of sliding window
         input; boundary=1000000, size of inner boundaries in sliding window, ie a 1,000,000 boundary with a 3,000,000bp
             sliding window will result in a window segmented into three 1,000,000bp chunks
-        returns; window_list; a list of sites to use for pairwise distance calculation
-        returns; window_dict; dict for every site listing the correct window to use for imputation"""
-        # initialize placeholder values
-        placeholder_list = [None, None, None, None, None]
-        windows_list = []
-        windows = [[], [], []]
+        input; site_index=None, parsed site labels as returned by parse_site_labels, site_labels are ignored if set
+        returns; window_ranges; int64 array of (start_row, end_row) offsets to use for pairwise distance calculation
+        returns; site_windows; int32 array listing the correct window to use for imputation for every site"""
+        if site_index is None:
+            site_index = kNNimputer.parse_site_labels(site_labels)
+        chromosome_codes, chromosomes, positions = site_index
+        # inner boundaries are checked before the window end, so a boundary over half the window extends the window
+        window_size = max(imputation_distance, 2 * boundary)
+        window_ranges = []
+        site_windows = np.zeros(len(positions), dtype=np.int32)
+        chromosome_breaks = np.flatnonzero(chromosome_codes[1:] != chromosome_codes[:-1]) + 1
+        chromosome_starts = np.concatenate(([0], chromosome_breaks)).astype(np.int64)
+        chromosome_ends = np.concatenate((chromosome_breaks, [len(positions)])).astype(np.int64)
+        for chromosome_start, chromosome_end in zip(chromosome_starts, chromosome_ends):
+            chromosome_positions = positions[chromosome_start:chromosome_end]
+            if np.any(np.diff(chromosome_positions) <= 0):
+                raise ValueError('Sites must be sorted by chromosome and position')
+            # chromosome relative row of the first site reached in each window of the current run of windows
+            arrival_rows = []
+            chain_start = 0
+            next_row = 0
+            window_start = chromosome_positions[0]
+            while True:
+                end_row = np.searchsorted(chromosome_positions, window_start + window_size, side='right')
+                has_next = end_row < len(chromosome_positions)
+                # sites carried from earlier windows lie past the window start, and a site is carried for at most two
+                # windows after the window it is first reached in
+                start_row = chain_start
+                if arrival_rows:
+                    start_row = max(start_row, np.searchsorted(chromosome_positions, window_start, side='right'))
+                if len(arrival_rows) > 1:
+                    start_row = max(start_row, arrival_rows[-2])
+                arrival_rows.append(next_row)
+                if end_row > start_row:
+                    window_ranges.append((chromosome_start + start_row, chromosome_start + end_row))
+                # sites past the second inner boundary are imputed in the next window, unless this is the last window
+                window_count = len(window_ranges) - 1
+                new_positions = chromosome_positions[next_row:end_row]
+                new_windows = np.full(len(new_positions), window_count, dtype=np.int32)
+                if has_next:
+                    new_windows[new_positions > window_start + 2 * boundary] += 1
+                site_windows[chromosome_start + next_row:chromosome_start + end_row] = new_windows
+                if not has_next:
+                    break
+                if end_row > next_row:
+                    window_start += boundary
+                else:
+                    # window only held sites carried from the previous window, restart at the next site
+                    window_start = chromosome_positions[end_row]
+                    arrival_rows = []
+                    chain_start = end_row
+                next_row = end_row
+        return np.asarray(window_ranges, dtype=np.int64).reshape(-1, 2), site_windows
+
+    @staticmethod
+    def stream_windows(blocks, imputation_distance=3000000, boundary=1000000):
+        """Streaming form of chromosome_imputation_chunks for a single chromosome. Sites are buffered only until the
+        current window is closed by a site past the window end, so memory depends on window size rather than
+        chromosome size. Window boundaries and site assignments follow chromosome_imputation_chunks, a site is kept
+        for one, two, or three windows depending on the window chunk it falls in when first read.
+        --------------------------
+        input; blocks, iterable of (positions, values) tuples sorted by position, values with sites as rows
+        input; imputation_distance=3000000, size of sliding window
+        input; boundary=1000000, size of inner boundaries in sliding window
+        yields; window_positions, window_values, impute_rows; sites in window, their values, and a boolean mask of
+            the sites assigned to the window for imputation"""
+        positions = np.empty(0, dtype=np.int64)
+        values = None
+        # window where each buffered site was first read, -1 if the site has not been reached, and the number of
+        # windows the site is included in
+        arrival = np.empty(0, dtype=np.int64)
+        level = np.empty(0, dtype=np.int64)
+        # inner boundaries are checked before the window end, so a boundary over half the window extends the window
+        window_size = max(imputation_distance, 2 * boundary)
+        blocks = iter(blocks)
+        exhausted = False
+        window_start = None
         window_count = 0
-        site_window_dict = {}
-        # iterate through site labels
-        for site in site_labels:
-            # split site by position and chromosome
-            site_split = site.split(':')
-            site_chromosome = site_split[0]
-            site_position = int(site_split[1])
-            # initialize variable for first site
-            if not placeholder_list[0]:
-                placeholder_list = [site_chromosome, site_position, site_position + boundary,
-                                    site_position + 2 * boundary, site_position + imputation_distance]
-                windows[0].append(site)
-                # assign site to imputation window
-                site_window_dict[site] = window_count
-            # set rules for chromosome change
-            elif placeholder_list[0] != site_chromosome:
-                placeholder_list = [site_chromosome, site_position, site_position + boundary,
-                                    site_position + 2 * boundary, site_position + imputation_distance]
-                windows_list.append(windows[0])
-                windows_list.append(windows[0])
-                windows_list.append(windows[0])
-                windows = [[site], [], []]
-                # advance window count
-                window_count += 1
-                # set dictionary value for new window
-                site_window_dict[site] = window_count
-            elif placeholder_list[0] == site_chromosome:
-                # rules to add sites to current window
-                # if site location not past second internal boundary add to current imputation window
-                if site_position <= placeholder_list[2]:
-                    windows[0].append(site)
-                    # rule to capture early sites
-                    site_window_dict[site] = window_count
-                elif placeholder_list[2] < site_position <= placeholder_list[3]:
-                    # middle sites are in original window and next window
-                    windows[0].append(site)
-                    windows[1].append(site)
-                    site_window_dict[site] = window_count
-                elif placeholder_list[3] < site_position <= placeholder_list[4]:
-                    # if site is past the second internal boundary site imputed at next window
-                    windows[0].append(site)
-                    windows[1].append(site)
-                    windows[2].append(site)
-                    site_window_dict[site] = window_count + 1
-                elif site_position > placeholder_list[4]:
-                    # initialize next window
-                    windows_list.append(windows[0])
-                    windows = [list(windows[1]), list(windows[2]), []]
-                    window_count += 1
-                    placeholder_list = [site_chromosome, placeholder_list[2], placeholder_list[3],
-                                        placeholder_list[3] + boundary,
-                                        placeholder_list[1] + boundary + imputation_distance]
-                    # place out of bounds site in current windows
-                    if site_position <= placeholder_list[2]:
-                        windows[0].append(site)
-                        site_window_dict[site] = window_count
-                    elif placeholder_list[2] < site_position <= placeholder_list[3]:
-                        windows[0].append(site)
-                        windows[1].append(site)
-                        site_window_dict[site] = window_count
-                    elif placeholder_list[3] < site_position <= placeholder_list[4]:
-                        windows[0].append(site)
-                        windows[1].append(site)
-                        windows[2].append(site)
-                        site_window_dict[site] = window_count + 1
-                    elif site_position > placeholder_list[4]:
-                        placeholder_list = [site_chromosome, site_position, site_position + boundary,
-                                            site_position + 2 * boundary, site_position + imputation_distance]
-                        windows_list.append(windows[0])
-                        windows_list.append(windows[0])
-                        windows_list.append(windows[0])
-                        windows = [[site], [], []]
-                        # advance window count
-                        window_count += 1
-                        # set dictionary value for new window
-                        site_window_dict[site] = window_count
-        # after loop add all windows to list for imputation
-        windows_list.append(windows[0])
-        windows_list.append(windows[0])
-        windows_list.append(windows[0])
-        return windows_list, site_window_dict
-
-    def chromosome_pairwise_windows(self, imputation_dist=6000000, boundary_dist=2000000, global_neighbors=None):
+        while True:
+            # buffer sites until the current window is closed by a site past the window end
+            while not exhausted and (window_start is None or positions[-1] <= window_start + window_size):
+                try:
+                    block_positions, block_values = next(blocks)
+                except StopIteration:
+                    exhausted = True
+                    break
+                block_positions = np.asarray(block_positions, dtype=np.int64)
+                if not block_positions.size:
+                    continue
+                if np.any(np.diff(block_positions) <= 0) or (positions.size and block_positions[0] <= positions[-1]):
+                    raise ValueError('Sites must be sorted by chromosome and position')
+                positions = np.concatenate((positions, block_positions))
+                values = block_values if values is None else np.concatenate((values, block_values))
+                arrival = np.concatenate((arrival, np.full(block_positions.size, -1, dtype=np.int64)))
+                level = np.concatenate((level, np.zeros(block_positions.size, dtype=np.int64)))
+                if window_start is None:
+                    window_start = positions[0]
+            if window_start is None:
+                return
+            end_row = np.searchsorted(positions, window_start + window_size, side='right')
+            has_next = end_row < positions.size
+            # sites reached in this window are placed in the current window, plus the next window if past the first
+            # inner boundary, plus the window after if past the second inner boundary
+            new_rows = arrival[:end_row] < 0
+            new_positions = positions[:end_row][new_rows]
+            arrival[:end_row][new_rows] = window_count
+            level[:end_row][new_rows] = (1 + (new_positions > window_start + boundary) +
+                                         (new_positions > window_start + 2 * boundary))
+            # sites past the second inner boundary are imputed in the next window, unless this is the last window
+            assignment = arrival[:end_row] + ((level[:end_row] == 3) & (has_next | (arrival[:end_row] < window_count)))
+            if end_row:
+                yield positions[:end_row], values[:end_row], assignment == window_count
+            if not has_next:
+                return
+            if np.any(new_rows):
+                window_start += boundary
+                keep_rows = arrival + level - 1 > window_count
+                keep_rows[end_row:] = True
+            else:
+                # window only held sites carried from the previous window, restart at the next site
+                window_start = positions[end_row]
+                keep_rows = np.arange(positions.size) >= end_row
+            positions = positions[keep_rows]
+            values = values[keep_rows]
+            arrival = arrival[keep_rows]
+            level = level[keep_rows]
+            window_count += 1
+
+    @staticmethod
+    def read_matrix_blocks(matrix_file, chunk_size=100000, separator='\t'):
+        """Read a chromosome, position methylation matrix in chunks, the format described in
+        adipose_project-summary_of_methods.sh, gzip compression is inferred from the file name
+        --------------------------
+        input; matrix_file, path to matrix with a header row, chromosome\tposition\tsample1ratio\tsample2ratio...
+        input; chunk_size=100000, number of rows to read at a time
+        yields; chromosome, positions, values; one block per chromosome within each chunk"""
+        columns = list(pd.read_csv(matrix_file, sep=separator, header=0, nrows=0))
+        column_types = {column: np.float64 for column in columns[2:]}
+        column_types[columns[0]] = str
+        column_types[columns[1]] = np.int64
+        reader = pd.read_csv(matrix_file, sep=separator, header=0, dtype=column_types, na_values=['NA'],
+                             chunksize=chunk_size)
+        for chunk in reader:
+            chromosomes = chunk[columns[0]].values
+            positions = chunk[columns[1]].values
+            values = chunk[columns[2:]].values
+            breaks = np.flatnonzero(chromosomes[1:] != chromosomes[:-1]) + 1
+            for start_row, end_row in zip(np.concatenate(([0], breaks)), np.concatenate((breaks, [len(chunk)]))):
+                yield chromosomes[start_row], positions[start_row:end_row], values[start_row:end_row]
+
+    @staticmethod
+    def impute_rows(values, neighbors, variance_tolerance=None, neighbor_distances=None):
+        """Impute missing values in place with the mean of the observed values of the nearest neighbors. All missing
+        values are imputed at once, neighbor values are gathered for every missing value with fancy indexing and
+        averaged in bulk. Missing values with no observed neighbor values are left missing.
+        --------------------------
+        input; values, numpy array with sites as rows and samples as columns
+        input; neighbors, (samples, k) array of nearest neighbor indexes returned by nearest_neighbors
+        input; variance_tolerance=None, missing values are left missing if the variance of the neighbor values is
+            above this value
+        input; neighbor_distances=None, (samples, k) neighbor distance array, if supplied neighbor values are
+            weighted by inverse distance"""
+        missing_rows, missing_columns = np.nonzero(np.isnan(values))
+        if not missing_rows.size:
+            return
+        # (missing values, k) array of neighbor values for each missing value
+        neighbor_values = values[missing_rows[:, np.newaxis], neighbors[missing_columns]]
+        observed = ~np.isnan(neighbor_values)
+        neighbor_count = observed.sum(axis=1)
+        neighbor_values = np.where(observed, neighbor_values, 0.0)
+        if neighbor_distances is None:
+            neighbor_weights = observed.astype(np.float64)
+        else:
+            # inverse distance weights, zero distances are clipped so identical neighbors dominate the average
+            inverse_distance = 1.0 / np.maximum(neighbor_distances, np.finfo(np.float64).eps)
+            neighbor_weights = np.where(observed, inverse_distance[missing_columns], 0.0)
+        neighbor_sum = (neighbor_weights * neighbor_values).sum(axis=1)
+        weight_sum = neighbor_weights.sum(axis=1)
+        imputed = neighbor_count > 0
+        neighbor_average = np.full(missing_rows.size, np.nan)
+        neighbor_average[imputed] = np.round(neighbor_sum[imputed] / weight_sum[imputed], 3)
+        if variance_tolerance:
+            # sample variance of observed neighbor values around their unweighted, unrounded mean, matching pandas var
+            neighbor_mean = neighbor_values.sum(axis=1) / np.maximum(neighbor_count, 1)
+            squared_deviation = np.where(observed, (neighbor_values - neighbor_mean[:, np.newaxis]) ** 2, 0.0)
+            variance_rows = neighbor_count > 1
+            neighbor_variance = np.zeros(missing_rows.size)
+            neighbor_variance[variance_rows] = (squared_deviation[variance_rows].sum(axis=1) /
+                                                (neighbor_count[variance_rows] - 1))
+            imputed &= neighbor_variance <= variance_tolerance
+        values[missing_rows[imputed], missing_columns[imputed]] = neighbor_average[imputed]
+
+    @staticmethod
+    def statistics_neighbors(statistics, global_neighbors=None, k=None):
+        """Pairwise distance matrix, and optionally nearest neighbors, from window sufficient statistics
+        --------------------------
+        input; statistics, (squared_distance, overlap) tuple returned by euclidean_statistics
+        returns; distance array, neighbor array and neighbor distance array (None if k is None)"""
+        pairwise_array = kNNimputer.statistics_distance(*statistics, global_neighbors=global_neighbors)
+        if k is None:
+            return pairwise_array, None, None
+        neighbors, neighbor_distances = kNNimputer.nearest_neighbors(pairwise_array, k=k)
+        return pairwise_array, neighbors, neighbor_distances
+
+    @staticmethod
+    def sliding_statistics(statistics, blocks, window_keys, window_values, previous_keys, previous_values):
+        """Update window sufficient statistics as a window slides. Sites enter a window in blocks, the statistics of
+        each entering block are kept in blocks and subtracted from the window when the block leaves, so each slide
+        only computes statistics for the entering sites. A block that only partly leaves the window is split.
+        --------------------------
+        input; statistics, (squared_distance, overlap) tuple of the previous window
+        input; blocks, deque of (first_key, last_key, block statistics) for the blocks summed in statistics, updated in
+            place
+        input; window_keys, window_values; increasing site keys, rows or positions, and values of the new window with
+            sites as rows and samples as columns
+        input; previous_keys, previous_values; site keys and values of the previous window
+        returns; updated (squared_distance, overlap) tuple"""
+        squared_distance, overlap = statistics
+        start_key = window_keys[0]
+        while blocks and blocks[0][1] < start_key:
+            leaving_squared_distance, leaving_overlap = blocks.popleft()[2]
+            squared_distance = squared_distance - leaving_squared_distance
+            overlap = overlap - leaving_overlap
+        if blocks and blocks[0][0] < start_key:
+            first_key, last_key, (block_squared_distance, block_overlap) = blocks.popleft()
+            leaving_rows = (previous_keys >= first_key) & (previous_keys < start_key)
+            leaving_squared_distance, leaving_overlap = kNNimputer.euclidean_statistics(
+                np.transpose(previous_values[leaving_rows]))
+            squared_distance = squared_distance - leaving_squared_distance
+            overlap = overlap - leaving_overlap
+            blocks.appendleft((start_key, last_key, (block_squared_distance - leaving_squared_distance,
+                                                     block_overlap - leaving_overlap)))
+        entering_rows = window_keys > previous_keys[-1]
+        if np.any(entering_rows):
+            entering_statistics = kNNimputer.euclidean_statistics(np.transpose(window_values[entering_rows]))
+            squared_distance = squared_distance + entering_statistics[0]
+            overlap = overlap + entering_statistics[1]
+            blocks.append((window_keys[entering_rows][0], window_keys[-1], entering_statistics))
+        return squared_distance, overlap
+
+    @staticmethod
+    def window_batch_distance_neighbors(values, row_ranges, global_neighbors=None, k=None, incremental=False,
+                                        distance='euclidean', approximate_options=None, window_callback=None):
+        """Pairwise distance matrices, and optionally nearest neighbors, for a list of windows
+        --------------------------
+        input; values, numpy array with sites as rows and samples as columns
+        input; row_ranges, list of (start_row, end_row) window offsets in genome order
+        input; incremental=False, if True consecutive overlapping windows update the previous window statistics
+            with the sites that left and entered the window rather than recalculating every pairwise distance
+        input; distance='euclidean', neighbor backend, the approximate backend does not return distance arrays
+        input; approximate_options=None, keyword arguments passed to approximate_nearest_neighbors
+        input; window_callback=None, called after each window with start_row, end_row, wall time and traced peak
+            memory in bytes, None if memory is not traced
+        returns; list of (distance array, neighbor array, neighbor distance array) tuples"""
+        if distance == 'approximate':
+            if k is None:
+                raise ValueError('k must be set for the approximate backend')
+            approximate_options = dict(approximate_options or {})
+            random_state = approximate_options.pop('random_state', None)
+            window_results = []
+            for start_row, end_row in row_ranges:
+                if window_callback is not None:
+                    start_time = _start_window_timer()
+                # seed each window from its offset so results do not depend on how windows are batched
+                window_random_state = None if random_state is None else [random_state, start_row]
+                neighbors, neighbor_distances = kNNimputer.approximate_nearest_neighbors(
+                    values[start_row:end_row], k=k, global_neighbors=global_neighbors,
+                    random_state=window_random_state, **approximate_options)
+                window_results.append((None, neighbors, neighbor_distances))
+                if window_callback is not None:
+                    _report_window(window_callback, start_row, end_row, start_time)
+            return window_results
+        window_results = []
+        statistics, blocks = None, None
+        previous_start, previous_end = 0, 0
+        for start_row, end_row in row_ranges:
+            if window_callback is not None:
+                start_time = _start_window_timer()
+            # only slide when the entering sites are fewer than the sites of the window
+            sliding = (incremental and statistics is not None and previous_start <= start_row <= previous_end <= end_row
+                       and end_row - previous_end < end_row - start_row)
+            if sliding:
+                statistics = kNNimputer.sliding_statistics(statistics, blocks, np.arange(start_row, end_row),
+                                                           values[start_row:end_row],
+                                                           np.arange(previous_start, previous_end),
+                                                           values[previous_start:previous_end])
+            else:
+                statistics = kNNimputer.euclidean_statistics(np.transpose(values[start_row:end_row]))
+                blocks = deque([(start_row, end_row - 1, statistics)])
+            previous_start, previous_end = start_row, end_row
+            window_results.append(kNNimputer.statistics_neighbors(statistics, global_neighbors=global_neighbors, k=k))
+            if window_callback is not None:
+                _report_window(window_callback, start_row, end_row, start_time)
+        return window_results
+
+    def chromosome_pairwise_windows(self, imputation_dist=6000000, boundary_dist=2000000, global_neighbors=None,
+                                    k=None, n_jobs=1, incremental=False, profile=None):
         """Calculate sliding imputation windows. Each site is assigned to the imputation window where the site lies on
          in the middle section
          -----------------------------
          input; self.row_labels, list of genome coordinate seperated by :, ie. chr1:11111111
-         returns; self.distance_matrix, list of sites to include in pairwise distance matrix
-         returns; self.chromosome_pairwise_dict, hash table linking coordinates to imputation matrix"""
-        windows_list, site_window_dict = kNNimputer.chromosome_imputation_chunks(self.row_labels,
-                                                                                 imputation_distance=imputation_dist,
-                                                                                 boundary=boundary_dist)
-        pairwise_arrays = []
-        for window in windows_list:
-            window_df = self.df.loc[window]
-            window_values = np.transpose(window_df.values)
-            pairwise_array = kNNimputer.euclidean(window_values, global_neighbors)
-            pairwise_arrays.append(pairwise_array)
-        self.distance_matrix = pairwise_arrays
-        self.chromosome_pairwise_dict = site_window_dict
+         input; k=None, if set nearest neighbors are found for each window alongside the distance matrix
+         input; n_jobs=1, number of processes used to compute windows
+         input; incremental=False, update distances as windows slide rather than recalculating each window
+         input; profile=None, RunProfile recording the window_index and window_neighbors stages and every window
+         returns; self.distance_matrix, list of pairwise distance arrays for each window, None for the approximate
+            backend
+         returns; self.window_ranges, (start_row, end_row) offsets of each window
+         returns; self.site_windows, array linking each row to its imputation window
+         returns; self.neighbors, self.neighbor_distances, lists of nearest neighbor arrays if k is set"""
+        sites, samples = self.df.shape
+        with _profile_stage(profile, 'window_index', sites=sites):
+            site_index = self.site_index
+            if site_index is None:
+                site_index = kNNimputer.parse_site_labels(self.row_labels)
+            window_ranges, site_windows = kNNimputer.chromosome_imputation_chunks(self.row_labels,
+                                                                                  imputation_distance=imputation_dist,
+                                                                                  boundary=boundary_dist,
+                                                                                  site_index=site_index)
+            row_ranges = [tuple(row_range) for row_range in window_ranges]
+        with _profile_stage(profile, 'window_neighbors', sites=sites, samples=samples):
+            if profile is not None:
+                chromosome_codes, chromosomes, positions = site_index
+                profile.start_windows(chromosomes[chromosome_codes[window_ranges[:, 0]]], samples=samples)
+            if n_jobs == 1:
+                window_results = kNNimputer.window_batch_distance_neighbors(
+                    self.df.values, row_ranges, global_neighbors=global_neighbors, k=k, incremental=incremental,
+                    distance=self.distance, approximate_options=self.approximate_options,
+                    window_callback=profile.add_window if profile is not None else None)
+            else:
+                window_results = self.parallel_windows(row_ranges, global_neighbors=global_neighbors, k=k,
+                                                       n_jobs=n_jobs, incremental=incremental, profile=profile)
+        self.distance_matrix = [window_result[0] for window_result in window_results]
+        self.window_ranges = window_ranges
+        self.site_windows = site_windows
+        if k is not None:
+            self.neighbors = [window_result[1] for window_result in window_results]
+            self.neighbor_distances = [window_result[2] for window_result in window_results]
+
+    def parallel_windows(self, row_ranges, global_neighbors=None, k=None, n_jobs=None, incremental=False,
+                         profile=None):
+        """Compute window distances and neighbors with a process pool. The methylation matrix is copied once into
+        shared memory and attached by each worker, windows are sent as batches of consecutive integer row ranges.
+        Workers are limited to a single BLAS thread so n_jobs processes use n_jobs cores
+        -----------------------------
+        input; row_ranges, list of (start_row, end_row) tuples
+        input; n_jobs=None, number of worker processes, None uses all available cores
+        input; incremental=False, update distances as windows slide within each batch
+        input; profile=None, RunProfile passed each window record as batches finish
+        returns; list of (distance array, neighbor array, neighbor distance array) tuples in window order"""
+        values = self.df.values
+        # float32 matrices stay float32 in shared memory, windows are converted to float64 as they are computed
+        dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.dtype(np.float64)
+        shared_values = shared_memory.SharedMemory(create=True, size=max(values.size * dtype.itemsize, 1))
+        try:
+            shared_array = np.ndarray(values.shape, dtype=dtype, buffer=shared_values.buf)
+            # copy straight into shared memory, without an intermediate float64 copy
+            shared_array[:] = values
+            del values
+            init_args = (shared_values.name, shared_array.shape, shared_array.dtype, global_neighbors, k, incremental,
+                         self.distance, self.approximate_options, profile is not None,
+                         profile is not None and profile.trace_memory)
+            with Pool(processes=n_jobs, initializer=_init_window_worker, initargs=init_args) as pool:
+                batch_count = min(len(row_ranges), 4 * (n_jobs or cpu_count()))
+                batches = [row_ranges[batch[0]:batch[-1] + 1]
+                           for batch in np.array_split(np.arange(len(row_ranges)), batch_count) if len(batch)]
+                window_results = []
+                # batches are returned in order as they finish so progress is reported while windows are computed
+                for batch_results, window_records in pool.imap(_window_worker, batches):
+                    window_results.extend(batch_results)
+                    if profile is not None:
+                        for window_record in window_records:
+                            profile.add_window(*window_record)
+            del shared_array
+        finally:
+            shared_values.close()
+            shared_values.unlink()
+        return window_results
+
+    @staticmethod
+    def nearest_neighbors(distance_matrix, k=5):
+        """Nearest neighbors for every sample in a distance matrix. Neighbors are selected with np.argpartition, the
+        sample itself is always excluded even if other samples are tied at zero distance
+        -----------------------------
+        input; distance_matrix, (samples, samples) pairwise distance array
+        input; k=5, number of neighbors, limited to the number of other samples
+        returns; neighbors, (samples, k) int array of neighbor indexes ordered by distance, ties broken by index
+        returns; neighbor_distances, (samples, k) array of neighbor distances"""
+        distance_matrix = np.array(distance_matrix, dtype=np.float64)
+        sample_count = distance_matrix.shape[0]
+        k = max(0, min(k, sample_count - 1))
+        np.fill_diagonal(distance_matrix, np.inf)
+        if 0 < k < sample_count - 1:
+            neighbors = np.argpartition(distance_matrix, k - 1, axis=1)[:, :k]
+        else:
+            neighbors = np.tile(np.arange(sample_count), (sample_count, 1))
+        neighbor_distances = np.take_along_axis(distance_matrix, neighbors, axis=1)
+        # order neighbors by distance then index, self matches have infinite distance and sort last
+        neighbor_order = np.lexsort((neighbors, neighbor_distances), axis=1)[:, :k]
+        neighbors = np.take_along_axis(neighbors, neighbor_order, axis=1)
+        neighbor_distances = np.take_along_axis(neighbor_distances, neighbor_order, axis=1)
+        return neighbors, neighbor_distances
+
+    @staticmethod
+    def approximate_nearest_neighbors(values, k=5, global_neighbors=None, sketch_size=64, candidate_factor=8,
+                                      random_state=None, block_size=256):
+        """Approximate nearest neighbors for large sample counts without a dense distance matrix. Missing values are
+        filled with the site mean and samples are sketched with a random projection, k * candidate_factor candidates
+        are taken from sketch distances and re-ranked with exact NaN aware euclidean distances.
+        -----------------------------
+        input; values, numpy array with sites as rows and samples as columns
+        input; k=5, number of neighbors, limited to the number of other samples
+        input; global_neighbors=None, fallback distance array for candidate pairs without shared sites, sketch
+            distances are used if None
+        input; sketch_size=64, number of random projections
+        input; candidate_factor=8, recall knob, number of candidates re-ranked per sample relative to k
+        input; random_state=None, seed passed to np.random.default_rng
+        input; block_size=256, number of samples processed at a time
+        returns; neighbors, (samples, k) int array of neighbor indexes ordered by distance
+        returns; neighbor_distances, (samples, k) array of neighbor distances"""
+        array = np.transpose(np.asarray(values, dtype=np.float64))
+        sample_count, site_count = array.shape
+        k = max(0, min(k, sample_count - 1))
+        candidate_count = min(sample_count - 1, int(np.ceil(k * max(candidate_factor, 1))))
+        # exact search is cheaper once every sample is a candidate
+        if candidate_count >= sample_count - 1:
+            pairwise_array = kNNimputer.statistics_distance(*kNNimputer.euclidean_statistics(array),
+                                                            global_neighbors=global_neighbors)
+            return kNNimputer.nearest_neighbors(pairwise_array, k=k)
+        observed = ~np.isnan(array)
+        observed_float = observed.astype(np.float64)
+        values = np.where(observed, array, 0.0)
+        squared_values = values * values
+        site_count_observed = observed_float.sum(axis=0)
+        site_means = np.divide(values.sum(axis=0), site_count_observed, out=np.zeros(site_count),
+                               where=site_count_observed > 0)
+        projection = np.random.default_rng(random_state).standard_normal((site_count, sketch_size))
+        sketch = np.where(observed, array, site_means) @ (projection / np.sqrt(sketch_size))
+        sketch_norms = np.sum(sketch * sketch, axis=1)
+        sample_index = np.arange(sample_count)
+        candidates = np.empty((sample_count, candidate_count), dtype=np.intp)
+        for start in range(0, sample_count, block_size):
+            block = slice(start, start + block_size)
+            sketch_distance = sketch_norms[block, np.newaxis] + sketch_norms - 2.0 * (sketch[block] @ sketch.T)
+            sketch_distance[np.arange(sketch_distance.shape[0]), sample_index[block]] = np.inf
+            candidates[block] = np.argpartition(sketch_distance, candidate_count - 1, axis=1)[:, :candidate_count]
+        # exact re-ranking, gathered candidate values are limited to about 64MB per block
+        candidate_distances = np.empty(candidates.shape)
+        rerank_block_size = max(1, int(8e6 // max(candidate_count * site_count, 1)))
+        for start in range(0, sample_count, rerank_block_size):
+            block = slice(start, start + rerank_block_size)
+            block_candidates = candidates[block]
+            candidate_values = values[block_candidates]
+            candidate_observed = observed_float[block_candidates]
+            # ||x - y||^2 over pairwise observed sites, expanded as in euclidean_statistics
+            squared_distance = (np.matmul(candidate_observed, squared_values[block, :, np.newaxis]) +
+                                np.matmul(candidate_values * candidate_values, observed_float[block, :, np.newaxis]) -
+                                2.0 * np.matmul(candidate_values, values[block, :, np.newaxis]))[:, :, 0]
+            overlap = np.matmul(candidate_observed, observed_float[block, :, np.newaxis])[:, :, 0]
+            block_distances = np.sqrt(np.maximum(squared_distance, 0.0))
+            no_overlap = overlap == 0
+            if np.any(no_overlap):
+                block_rows = np.broadcast_to(sample_index[block, np.newaxis], block_candidates.shape)
+                if global_neighbors is not None:
+                    fallback = np.asarray(global_neighbors)[block_rows, block_candidates]
+                else:
+                    sketch_product = np.einsum('ijk,ijk->ij', sketch[block_rows], sketch[block_candidates])
+                    fallback = np.sqrt(np.maximum(sketch_norms[block_rows] + sketch_norms[block_candidates] -
+                                                  2.0 * sketch_product, 0.0))
+                block_distances[no_overlap] = fallback[no_overlap]
+            candidate_distances[block] = block_distances
+        # order candidates by exact distance then index
+        candidate_order = np.lexsort((candidates, candidate_distances), axis=1)[:, :k]
+        neighbors = np.take_along_axis(candidates, candidate_order, axis=1)
+        neighbor_distances = np.take_along_axis(candidate_distances, candidate_order, axis=1)
+        return neighbors, neighbor_distances
 
     def get_nearest_neighbors(self, k=5):
-        neighbor_dicts = []
-        for distance_matrix in self.distance_matrix:
-            local_neighbor_dict = {}
-            for sample in zip(self.samples, distance_matrix):
-                sample_key = list(self.samples)
-                sorted_sample_key = [a for b, a in sorted(zip(sample[1], sample_key))]
-                neighbors = [sample_key.index(x) for x in sorted_sample_key[1:(k+1)]]
-                local_neighbor_dict[sample_key.index(sample[0])] = neighbors
-            neighbor_dicts.append(local_neighbor_dict)
-        self.neighbor_dicts = neighbor_dicts
+        nearest_neighbors = [kNNimputer.nearest_neighbors(distance_matrix, k=k)
+                             for distance_matrix in self.distance_matrix]
+        self.neighbors = [neighbors for neighbors, neighbor_distances in nearest_neighbors]
+        self.neighbor_distances = [neighbor_distances for neighbors, neighbor_distances in nearest_neighbors]
+
+    def checkpointed_imputation(self, checkpoint_dir=None, imputation_dist=6000000, boundary_dist=2000000,
+                                global_neighbors=None, k=5, missing_value_tolerance=0.0, variance_tolerance=None,
+                                n_jobs=1, weighted=False, incremental=False, profile=None):
+        """Impute one chromosome at a time, each imputed chromosome is written to checkpoint_dir as a binary matrix and
+        recorded in manifest.json as soon as it is finished. Chromosomes already in the manifest with the same input
+        hash and imputation settings are loaded rather than imputed, so an interrupted run resumes where it stopped
+        and a rerun only imputes chromosomes whose input changed. Completed chromosomes keep the global fallback
+        distances of the run that imputed them
+        -----------------------------
+        input; checkpoint_dir, directory holding the manifest and a chromosome_<label> binary matrix per chromosome
+        input; global_neighbors=None, global distance array used when a sample pair shares no sites in a window
+        input; profile=None, RunProfile recording the stages of every imputed chromosome
+        returns; self.df, imputed dataframe of all chromosomes, window and neighbor attributes are not kept"""
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        manifest_path = os.path.join(checkpoint_dir, 'manifest.json')
+        manifest = {'units': {}}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+
+        def write_manifest():
+            with open(manifest_path + '.tmp', 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=1)
+            os.replace(manifest_path + '.tmp', manifest_path)
+
+        settings = DistanceCache.key(imputation_dist, boundary_dist, k, missing_value_tolerance, variance_tolerance,
+                                     weighted, self.distance, sorted(self.approximate_options.items()))
+        site_index = self.site_index
+        if site_index is None:
+            site_index = kNNimputer.parse_site_labels(self.row_labels)
+        chromosome_codes, chromosomes, positions = site_index
+        chromosome_breaks = np.flatnonzero(chromosome_codes[1:] != chromosome_codes[:-1]) + 1
+        unit_values, kept_rows, unit_labels = [], [], set()
+        for start_row, end_row in zip(np.concatenate(([0], chromosome_breaks)),
+                                      np.concatenate((chromosome_breaks, [len(positions)]))):
+            if end_row <= start_row:
+                continue
+            chromosome = str(chromosomes[chromosome_codes[start_row]])
+            if chromosome in unit_labels:
+                raise ValueError('Sites must be sorted by chromosome and position')
+            unit_labels.add(chromosome)
+            unit_site_index = (np.zeros(end_row - start_row, dtype=np.int32), np.asarray([chromosome], dtype=object),
+                               positions[start_row:end_row])
+            unit_df = self.df.iloc[start_row:end_row]
+            unit_hash = DistanceCache.key(DistanceCache.matrix_hash(unit_df, site_index=unit_site_index), settings)
+            unit_path = os.path.join(checkpoint_dir, 'chromosome_' + chromosome)
+            unit = manifest['units'].get(chromosome)
+            # a unit is only complete once its binary header and its manifest entry are written
+            if (unit is None or unit['hash'] != unit_hash
+                    or not os.path.exists(os.path.join(unit_path, 'header.json'))):
+                print('Imputing Chromosome ' + chromosome)
+                unit_imputer = kNNimputer(unit_df, distance=self.distance, site_index=unit_site_index,
+                                          **self.approximate_options)
+                unit_imputer.chromosome_pairwise_windows(imputation_dist=imputation_dist, boundary_dist=boundary_dist,
+                                                         global_neighbors=global_neighbors, k=k, n_jobs=n_jobs,
+                                                         incremental=incremental, profile=profile)
+                with _profile_stage(profile, 'imputation', sites=end_row - start_row, samples=len(self.samples)):
+                    unit_imputer.nearest_neighbor_imputation(missing_value_tolerance=missing_value_tolerance,
+                                                             variance_tolerance=variance_tolerance,
+                                                             weighted=weighted)
+                unit_imputer.save_binary(unit_path, dtype=np.float64)
+                manifest['units'][chromosome] = {'hash': unit_hash, 'sites': len(unit_imputer.df.index)}
+                write_manifest()
+            else:
+                print('Loading Completed Chromosome ' + chromosome)
+            values, samples, row_labels, unit_index = load_binary_matrix(unit_path)
+            # rows below missing_value_tolerance are dropped by imputation
+            kept_rows.append(np.isin(positions[start_row:end_row], unit_index[2]))
+            unit_values.append(values)
+        # remove chromosomes no longer in the input
+        for chromosome in set(manifest['units']) - unit_labels:
+            shutil.rmtree(os.path.join(checkpoint_dir, 'chromosome_' + chromosome), ignore_errors=True)
+            del manifest['units'][chromosome]
+            write_manifest()
+        kept_rows = np.concatenate(kept_rows) if kept_rows else np.zeros(0, dtype=bool)
+        if self.site_index is not None:
+            self.site_index = (chromosome_codes[kept_rows], chromosomes, positions[kept_rows])
+        values = np.concatenate(unit_values) if unit_values else np.zeros((0, len(self.samples)))
+        self.df = pd.DataFrame(values, index=self.df.index[kept_rows], columns=[str(x) for x in self.samples])
+
+    @classmethod
+    def from_binary(cls, path=None, mmap_mode='r', **options):
+        """Load a methylation matrix written by save_binary or matrix_to_binary. Values are memory mapped rather than
+        parsed, rows are indexed by row number and the chromosome and position of each row are kept in self.site_index
+        -----------------------------
+        input; path, binary matrix directory
+        input; mmap_mode='r', np.memmap mode, 'c' for copy on write values
+        input; options, kNNimputer arguments"""
+        values, samples, row_labels, site_index = load_binary_matrix(path, mmap_mode=mmap_mode)
+        return cls(pd.DataFrame(values, index=row_labels, columns=samples, copy=False), site_index=site_index,
+                   **options)
+
+    def save_binary(self, path=None, dtype=np.float32):
+        """Save self.df as a binary matrix directory, site labels are stored as chromosome codes and positions
+        -----------------------------
+        input; path, directory to write
+        input; dtype=np.float32, value type of the saved value block"""
+        site_index = self.site_index
+        if site_index is None:
+            site_index = kNNimputer.parse_site_labels(self.df.index)
+        chromosome_codes, chromosomes, positions = site_index
+        values = self.df.values
+        chromosome_breaks = np.flatnonzero(chromosome_codes[1:] != chromosome_codes[:-1]) + 1
+        blocks = ((chromosomes[chromosome_codes[start_row]], positions[start_row:end_row], values[start_row:end_row])
+                  for start_row, end_row in zip(np.concatenate(([0], chromosome_breaks)),
+                                                np.concatenate((chromosome_breaks, [len(positions)]))))
+        write_binary_matrix(path, blocks, self.df.columns, sites=True, dtype=dtype)
 
     def pairwise_matrix(self):
         self.distance_matrix = [kNNimputer.euclidean(self.values)]
 
-    def nearest_neighbor_imputation(self, missing_value_tolerance=0.9, variance_tolerance=None):
+    def nearest_neighbor_imputation(self, missing_value_tolerance=0.9, variance_tolerance=None, weighted=False):
         # drop low information rows
         numeric_count = self.df.count(axis=1) / len(list(self.df))
         # Pandas series object, drop categories below missing_value_tolerance
-        below_threshold_index = numeric_count.drop(numeric_count[numeric_count >= missing_value_tolerance].index)
-        # Designate columns above variance_drop_proportion threshold
-        # of series labels
-        self.df = self.df.drop(below_threshold_index.index)
+        above_threshold_rows = (numeric_count >= missing_value_tolerance).values
+        self.df = self.df[above_threshold_rows]
+        if self.site_index is not None:
+            chromosome_codes, chromosomes, positions = self.site_index
+            self.site_index = (chromosome_codes[above_threshold_rows], chromosomes, positions[above_threshold_rows])
+        site_windows = None
+        if self.site_windows is not None:
+            site_windows = self.site_windows[above_threshold_rows]
         # if the columns are labeled by a number pandas will pull by the label instead of the index which can lead to
         # unpredictable results, ensure all labels are strings to get around this
-        self.df.columns = [str(x) for x in self.samples]
-        for index, row in self.df.iterrows():
-            null_methylation_values = np.argwhere(np.isnan(row.values))
-            if len(null_methylation_values) > 0:
-                if self.chromosome_pairwise_dict:
-                    null_site_neighbor_dict = self.neighbor_dicts[self.chromosome_pairwise_dict[index]]
-                else:
-                    null_site_neighbor_dict = self.neighbor_dicts[0]
-                for null_site in null_methylation_values:
-                    neighbors = null_site_neighbor_dict[null_site[0]]
-                    if variance_tolerance:
-                        if (row[neighbors]).var(skipna=True) > variance_tolerance:
-                            print('what')
-                    neighbor_average = round((row[neighbors]).mean(skipna=True), 3)
-                    row[null_site[0]] = neighbor_average
+        columns = [str(x) for x in self.samples]
+        values = self.df.to_numpy(dtype=np.float64, copy=True)
+        if site_windows is None:
+            kNNimputer.impute_rows(values, self.neighbors[0], variance_tolerance=variance_tolerance,
+                                   neighbor_distances=self.neighbor_distances[0] if weighted else None)
+        else:
+            # rows are ordered by window, impute each run of rows sharing a window in place
+            window_breaks = np.flatnonzero(site_windows[1:] != site_windows[:-1]) + 1
+            for start_row, end_row in zip(np.concatenate(([0], window_breaks)),
+                                          np.concatenate((window_breaks, [len(site_windows)]))):
+                if end_row > start_row:
+                    window = site_windows[start_row]
+                    kNNimputer.impute_rows(values[start_row:end_row], self.neighbors[window],
+                                           variance_tolerance=variance_tolerance,
+                                           neighbor_distances=self.neighbor_distances[window] if weighted else None)
+        self.df = pd.DataFrame(values, index=self.df.index, columns=columns)
 
 
 def accuracy_assessment(test_df=None, proportion_of_random_sites=0.01, k=5,
-                        imputation_dist=6000000, boundary_dist=2000000):
+                        imputation_dist=6000000, boundary_dist=2000000, random_state=None, **run_options):
+    """Mask a random proportion of observed values, impute them, and compare against the masked values. Masked cells
+    are drawn as random flat indexes so no list of matrix coordinates is built.
+    ----------------------------------------
+    input; random_state=None, seed passed to np.random.default_rng, use the same seed to mask the same cells
+    input; run_options, additional keyword arguments passed to kNNimputer.run
+    returns; [absolute_error, validation_value, test_value, cpg_site_index] list of arrays for every masked cell"""
     # drop all rows with missing information
     test_df = test_df[test_df.notnull().all(1)]
-    validation_df = pd.DataFrame.copy(test_df)
-    ix = [(row, col) for row in range(test_df.shape[0]) for col in range(test_df.shape[1])]
-    for row, col in random.sample(ix, int(round(proportion_of_random_sites * len(ix)))):
-        test_df.iat[row, col] = np.nan
-    nan_index = np.where(np.asanyarray(np.isnan(test_df)))
-    test_imputer = kNNimputer(dataframe=test_df)
-    test_imputer.run(imputation_dist=imputation_dist, boundary_dist=boundary_dist, k=k, missing_value_tolerance=0.0)
+    test_values = test_df.to_numpy(dtype=np.float64, copy=True)
+    masked_count = int(round(proportion_of_random_sites * test_values.size))
+    masked_sites = np.random.default_rng(random_state).choice(test_values.size, masked_count, replace=False)
+    masked_rows, masked_columns = np.unravel_index(np.sort(masked_sites), test_values.shape)
+    validation_values = test_values[masked_rows, masked_columns]
+    test_values[masked_rows, masked_columns] = np.nan
+    test_imputer = kNNimputer(dataframe=pd.DataFrame(test_values, index=test_df.index, columns=test_df.columns))
+    test_imputer.run(imputation_dist=imputation_dist, boundary_dist=boundary_dist, k=k, missing_value_tolerance=0.0,
+                     **run_options)
+    test_imputed = test_imputer.df.values[masked_rows, masked_columns]
     # absolute_error, validation_value, test_value, cpg_site_index
-    validation_list = [[], [], [], []]
-    for index in zip(nan_index[0], nan_index[1]):
-        validation_list[3].append(index[0])
-        test_value = test_imputer.df.iat[index[0], index[1]]
-        validation_value = validation_df.iat[index[0], index[1]]
-        absolute_error = np.absolute(test_value - validation_value)
-        validation_list[2].append(test_value)
-        validation_list[0].append(absolute_error)
-        validation_list[1].append(validation_value)
-    return validation_list
+    return [np.absolute(test_imputed - validation_values), validation_values, test_imputed, masked_rows]
+
+
+# per process benchmark matrix, set by _init_benchmark_worker
+_benchmark_state = {}
+
+
+def _init_benchmark_worker(test_df=None):
+    """Hold the benchmark matrix in each worker so it is pickled once per process rather than once per setting"""
+    _benchmark_state['test_df'] = test_df
+
+
+def _benchmark_worker(settings):
+    """Accuracy, wall time, and peak traced memory for a single imputation setting"""
+    k, imputation_dist, boundary_dist, proportion_of_random_sites, random_state = settings
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    validation_list = accuracy_assessment(test_df=_benchmark_state['test_df'],
+                                          proportion_of_random_sites=proportion_of_random_sites, k=k,
+                                          imputation_dist=imputation_dist, boundary_dist=boundary_dist,
+                                          random_state=random_state)
+    wall_time = time.perf_counter() - start_time
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    absolute_error = validation_list[0]
+    imputed = ~np.isnan(absolute_error)
+    mean_absolute_error = np.mean(absolute_error[imputed]) if np.any(imputed) else np.nan
+    root_mean_squared_error = np.sqrt(np.mean(absolute_error[imputed] ** 2)) if np.any(imputed) else np.nan
+    return [k, imputation_dist, boundary_dist, len(absolute_error), int(np.sum(imputed)), mean_absolute_error,
+            root_mean_squared_error, wall_time, peak_memory / 1024 ** 2]
+
+
+def imputation_benchmark(test_df=None, k_values=(5,), imputation_dists=(6000000,), boundary_dists=(2000000,),
+                         proportion_of_random_sites=0.01, n_jobs=1, random_state=0):
+    """Sweep imputation settings with accuracy_assessment to balance accuracy against runtime. Every setting masks
+    the same cells, settings are run in parallel with a process pool.
+    ----------------------------------------
+    input; test_df, methylation values with sites as rows and samples as columns
+    input; k_values, imputation_dists, boundary_dists; grid of settings to test, boundary_dist values larger than
+        the imputation_dist are skipped
+    input; n_jobs=1, number of settings run in parallel
+    input; random_state=0, seed used to mask cells
+    returns; pandas DataFrame with masked and imputed cell counts, MAE, RMSE, wall time (s), and peak traced memory
+        (MB) for each setting"""
+    settings = [(k, imputation_dist, boundary_dist, proportion_of_random_sites, random_state)
+                for k in k_values for imputation_dist in imputation_dists for boundary_dist in boundary_dists
+                if boundary_dist <= imputation_dist]
+    if n_jobs == 1:
+        _init_benchmark_worker(test_df)
+        benchmark = [_benchmark_worker(setting) for setting in settings]
+    else:
+        with Pool(processes=n_jobs, initializer=_init_benchmark_worker, initargs=(test_df,)) as pool:
+            benchmark = pool.map(_benchmark_worker, settings, chunksize=1)
+    return pd.DataFrame(benchmark, columns=['k', 'imputation_dist', 'boundary_dist', 'masked_sites', 'imputed_sites',
+                                            'mae', 'rmse', 'wall_time', 'peak_memory_mb'])
+
+
+def stream_imputation(matrix_file=None, output_file=None, imputation_dist=6000000, boundary_dist=2000000, k=5,
+                      missing_value_tolerance=0.0, variance_tolerance=None, weighted=False, incremental=False,
+                      chunk_size=100000, global_fallback=True, separator='\t'):
+    """Impute a chromosome, position methylation matrix too large to hold in memory. The sorted matrix is read in
+    chunks and only the sites of the current imputation window are buffered, imputed rows are written as each window
+    is finished, so peak memory depends on window size rather than genome size.
+    ----------------------------------------
+    input; matrix_file, sorted matrix with header, chromosome\tposition\tsample1ratio..., may be gzipped
+    input; output_file, path to write imputed matrix in the same format, gzipped if the name ends in .gz
+    input; global_fallback=True, make an additional pass over the matrix to compute global distances used for sample
+        pairs without shared sites in a window
+    input; incremental=False, update distances as windows slide rather than recalculating each window
+    input; chunk_size=100000, number of rows read at a time"""
+    samples = list(pd.read_csv(matrix_file, sep=separator, header=0, nrows=0))
+    global_neighbors = None
+    if global_fallback:
+        print('Getting Global Neighbors')
+        squared_distance, overlap = 0, 0
+        for chromosome, positions, values in kNNimputer.read_matrix_blocks(matrix_file, chunk_size=chunk_size,
+                                                                           separator=separator):
+            block_squared_distance, block_overlap = kNNimputer.euclidean_statistics(np.transpose(values))
+            squared_distance = squared_distance + block_squared_distance
+            overlap = overlap + block_overlap
+        global_neighbors = kNNimputer.statistics_distance(squared_distance, overlap)
+    print('Imputing Windows')
+    completed_chromosomes = set()
+    blocks = kNNimputer.read_matrix_blocks(matrix_file, chunk_size=chunk_size, separator=separator)
+    with (gzip.open(output_file, 'wt') if output_file.endswith('.gz') else open(output_file, 'w')) as output:
+        output.write(separator.join(samples) + '\n')
+        for chromosome, chromosome_blocks in groupby(blocks, key=lambda block: block[0]):
+            if chromosome in completed_chromosomes:
+                raise ValueError('Sites must be sorted by chromosome and position')
+            window_blocks = ((positions, values) for _, positions, values in chromosome_blocks)
+            statistics, sliding_blocks, previous_positions, previous_values = None, None, None, None
+            for window_positions, window_values, impute_rows in kNNimputer.stream_windows(
+                    window_blocks, imputation_distance=imputation_dist, boundary=boundary_dist):
+                # windows are contiguous in position, slide while they overlap the previous window
+                if incremental and statistics is not None and window_positions[0] <= previous_positions[-1]:
+                    statistics = kNNimputer.sliding_statistics(statistics, sliding_blocks, window_positions,
+                                                               window_values, previous_positions, previous_values)
+                else:
+                    statistics = kNNimputer.euclidean_statistics(np.transpose(window_values))
+                    sliding_blocks = deque([(window_positions[0], window_positions[-1], statistics)])
+                previous_positions, previous_values = window_positions, window_values
+                pairwise_array, neighbors, neighbor_distances = kNNimputer.statistics_neighbors(
+                    statistics, global_neighbors=global_neighbors, k=k)
+                imputed_values = window_values[impute_rows]
+                # drop low information rows
+                numeric_count = np.sum(~np.isnan(imputed_values), axis=1) / imputed_values.shape[1]
+                keep_rows = numeric_count >= missing_value_tolerance
+                imputed_values = imputed_values[keep_rows]
+                kNNimputer.impute_rows(imputed_values, neighbors, variance_tolerance=variance_tolerance,
+                                       neighbor_distances=neighbor_distances if weighted else None)
+                imputed_df = pd.DataFrame(imputed_values, columns=samples[2:])
+                imputed_df.insert(0, samples[1], window_positions[impute_rows][keep_rows])
+                imputed_df.insert(0, samples[0], chromosome)
+                imputed_df.to_csv(output, sep=separator, header=False, index=False, na_rep='NA')
+            completed_chromosomes.add(chromosome)
+
+
+def matrix_to_binary(matrix_file=None, path=None, chunk_size=100000, separator='\t', dtype=np.float32):
+    """Convert a chromosome, position methylation matrix to a binary matrix directory loaded with
+    kNNimputer.from_binary, the matrix is read in chunks so it is never held in memory
+    ----------------------------------------
+    input; matrix_file, matrix with header, chromosome\tposition\tsample1ratio..., may be gzipped
+    input; path, directory to write
+    input; dtype=np.float32, value type of the saved value block"""
+    samples = list(pd.read_csv(matrix_file, sep=separator, header=0, nrows=0))
+    write_binary_matrix(path, kNNimputer.read_matrix_blocks(matrix_file, chunk_size=chunk_size, separator=separator),
+                        samples[2:], sites=True, dtype=dtype)
+
+
+def neighbor_recall_benchmark(test_df=None, k=5, imputation_dist=6000000, boundary_dist=2000000,
+                              candidate_factors=(2, 4, 8, 16), sketch_size=64, random_state=None):
+    """Benchmark the approximate neighbor backend against the exact backend
+    ----------------------------------------
+    input; test_df, methylation values with sites as rows and samples as columns
+    input; candidate_factors=(2, 4, 8, 16), approximate backend recall knob values to test
+    returns; pandas DataFrame with recall@k and wall time for the exact backend and each candidate factor"""
+    exact_imputer = kNNimputer(dataframe=test_df)
+    start_time = time.perf_counter()
+    exact_imputer.chromosome_pairwise_windows(imputation_dist=imputation_dist, boundary_dist=boundary_dist, k=k)
+    benchmark = [['euclidean', None, 1.0, time.perf_counter() - start_time]]
+    for candidate_factor in candidate_factors:
+        approximate_imputer = kNNimputer(dataframe=test_df, distance='approximate', sketch_size=sketch_size,
+                                         candidate_factor=candidate_factor, random_state=random_state)
+        start_time = time.perf_counter()
+        approximate_imputer.chromosome_pairwise_windows(imputation_dist=imputation_dist, boundary_dist=boundary_dist,
+                                                        k=k)
+        wall_time = time.perf_counter() - start_time
+        # recall@k, proportion of exact neighbors recovered by the approximate backend
+        found, total = 0, 0
+        for exact_neighbors, approximate_neighbors in zip(exact_imputer.neighbors, approximate_imputer.neighbors):
+            for exact_row, approximate_row in zip(exact_neighbors, approximate_neighbors):
+                found += len(np.intersect1d(exact_row, approximate_row))
+                total += len(exact_row)
+        benchmark.append(['approximate', candidate_factor, found / total if total else 1.0, wall_time])
+    return pd.DataFrame(benchmark, columns=['distance', 'candidate_factor', 'recall_at_k', 'wall_time'])
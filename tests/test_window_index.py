@@ -0,0 +1,152 @@
+#! /usr/env python3
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from kNNimputer import kNNimputer
+
+
+def list_imputation_chunks(site_labels, imputation_distance=3000000, boundary=1000000):
+    """Frozen copy of the list based kNNimputer.chromosome_imputation_chunks replaced by the array backed window index,
+    returns the per window site label lists and the site to window dict"""
+    # initialize placeholder values
+    placeholder_list = [None, None, None, None, None]
+    windows_list = []
+    windows = [[], [], []]
+    window_count = 0
+    site_window_dict = {}
+    # iterate through site labels
+    for site in site_labels:
+        # split site by position and chromosome
+        site_split = site.split(':')
+        site_chromosome = site_split[0]
+        site_position = int(site_split[1])
+        # initialize variable for first site
+        if not placeholder_list[0]:
+            placeholder_list = [site_chromosome, site_position, site_position + boundary,
+                                site_position + 2 * boundary, site_position + imputation_distance]
+            windows[0].append(site)
+            # assign site to imputation window
+            site_window_dict[site] = window_count
+        # set rules for chromosome change
+        elif placeholder_list[0] != site_chromosome:
+            placeholder_list = [site_chromosome, site_position, site_position + boundary,
+                                site_position + 2 * boundary, site_position + imputation_distance]
+            windows_list.append(windows[0])
+            windows_list.append(windows[0])
+            windows_list.append(windows[0])
+            windows = [[site], [], []]
+            # advance window count
+            window_count += 1
+            # set dictionary value for new window
+            site_window_dict[site] = window_count
+        elif placeholder_list[0] == site_chromosome:
+            # rules to add sites to current window
+            # if site location not past second internal boundary add to current imputation window
+            if site_position <= placeholder_list[2]:
+                windows[0].append(site)
+                # rule to capture early sites
+                site_window_dict[site] = window_count
+            elif placeholder_list[2] < site_position <= placeholder_list[3]:
+                # middle sites are in original window and next window
+                windows[0].append(site)
+                windows[1].append(site)
+                site_window_dict[site] = window_count
+            elif placeholder_list[3] < site_position <= placeholder_list[4]:
+                # if site is past the second internal boundary site imputed at next window
+                windows[0].append(site)
+                windows[1].append(site)
+                windows[2].append(site)
+                site_window_dict[site] = window_count + 1
+            elif site_position > placeholder_list[4]:
+                # initialize next window
+                windows_list.append(windows[0])
+                windows = [list(windows[1]), list(windows[2]), []]
+                window_count += 1
+                placeholder_list = [site_chromosome, placeholder_list[2], placeholder_list[3],
+                                    placeholder_list[3] + boundary,
+                                    placeholder_list[1] + boundary + imputation_distance]
+                # place out of bounds site in current windows
+                if site_position <= placeholder_list[2]:
+                    windows[0].append(site)
+                    site_window_dict[site] = window_count
+                elif placeholder_list[2] < site_position <= placeholder_list[3]:
+                    windows[0].append(site)
+                    windows[1].append(site)
+                    site_window_dict[site] = window_count
+                elif placeholder_list[3] < site_position <= placeholder_list[4]:
+                    windows[0].append(site)
+                    windows[1].append(site)
+                    windows[2].append(site)
+                    site_window_dict[site] = window_count + 1
+                elif site_position > placeholder_list[4]:
+                    placeholder_list = [site_chromosome, site_position, site_position + boundary,
+                                        site_position + 2 * boundary, site_position + imputation_distance]
+                    windows_list.append(windows[0])
+                    windows_list.append(windows[0])
+                    windows_list.append(windows[0])
+                    windows = [[site], [], []]
+                    # advance window count
+                    window_count += 1
+                    # set dictionary value for new window
+                    site_window_dict[site] = window_count
+    # after loop add all windows to list for imputation
+    windows_list.append(windows[0])
+    windows_list.append(windows[0])
+    windows_list.append(windows[0])
+    return windows_list, site_window_dict
+
+
+def baseline_windows(site_labels, imputation_distance, boundary):
+    """Distinct, non-empty windows of the list based implementation in order, windows appended more than once at
+    chromosome changes are kept once"""
+    windows_list, site_window_dict = list_imputation_chunks(site_labels, imputation_distance=imputation_distance,
+                                                            boundary=boundary)
+    windows = []
+    previous_window = None
+    for window in windows_list:
+        if window is not previous_window and window:
+            windows.append(list(window))
+        previous_window = window
+    return windows
+
+
+def random_layout(random_generator):
+    """Sorted site labels over several chromosomes, gaps are a mix of short steps within a window and long jumps that
+    restart a window chain, window sizes include boundaries over half the imputation distance"""
+    boundary = int(random_generator.integers(50, 500))
+    imputation_distance = int(boundary * random_generator.choice([1.0, 1.5, 2.0, 2.5, 3.0, 4.0, 5.0]))
+    site_labels = []
+    for chromosome in range(int(random_generator.integers(1, 5))):
+        position = int(random_generator.integers(1, 1000))
+        for site in range(int(random_generator.integers(1, 120))):
+            site_labels.append('chr' + str(chromosome + 1) + ':' + str(position))
+            if random_generator.random() < 0.1:
+                position += int(random_generator.integers(imputation_distance, 4 * imputation_distance))
+            else:
+                position += int(random_generator.integers(1, boundary))
+    return site_labels, imputation_distance, boundary
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_windows_match_list_implementation(seed):
+    random_generator = np.random.default_rng(seed)
+    for layout in range(1000):
+        site_labels, imputation_distance, boundary = random_layout(random_generator)
+        window_ranges, site_windows = kNNimputer.chromosome_imputation_chunks(
+            site_labels, imputation_distance=imputation_distance, boundary=boundary)
+        windows = [site_labels[start_row:end_row] for start_row, end_row in window_ranges]
+        assert windows == baseline_windows(site_labels, imputation_distance, boundary)
+        # every site indexes a window holding the site
+        rows = np.arange(len(site_labels))
+        assert np.all(window_ranges[site_windows, 0] <= rows)
+        assert np.all(rows < window_ranges[site_windows, 1])
+
+
+def test_unsorted_sites_raise():
+    with pytest.raises(ValueError):
+        kNNimputer.chromosome_imputation_chunks(['1:200', '1:100'], imputation_distance=300, boundary=100)